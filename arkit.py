@@ -11,11 +11,29 @@ Notice:
 '''
 
 
+import array
+import bisect
+import collections
+import concurrent.futures
+import hashlib
+import io
+import mmap
+import os
 import struct
 import zlib
 import sys
 import logging
 
+#Faster zlib compatible implementations are optional, stdlib zlib is always there
+try:
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+try:
+    from zlib_ng import zlib_ng
+except ImportError:
+    zlib_ng = None
+
 
 __author__ = "James E"
 __contact__ = "https://github.com/project-umbrella/arkit.py"
@@ -37,13 +55,337 @@ class SignatureUnpackException(UnpackException):
 class CorruptUnpackException(UnpackException):
     pass
 
-def unpack(src, dst):
+class PackException(Exception):
+    pass
+
+UnpackStats = collections.namedtuple('UnpackStats', ['chunks', 'bytes_read', 'bytes_written'])
+ArchiveInfo = collections.namedtuple('ArchiveInfo', ['chunk_size', 'size_packed', 'size_unpacked', 'data_offset', 'compression_index'])
+
+ARCHIVE_SIGNATURE = 2653586369
+DEFAULT_CHUNK_SIZE = 131072
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+DEFAULT_PARALLEL_THRESHOLD = 16 * 1024 * 1024
+DEFAULT_CACHE_CHUNKS = 8
+DEFAULT_CHECKPOINT_BYTES = 64 * 1024 * 1024
+
+#Decompression backends in order of preference; each one is a module with the zlib API
+CODECS = collections.OrderedDict([('isal', isal_zlib), ('zlib-ng', zlib_ng), ('zlib', zlib)])
+
+_HEADER = struct.Struct('<qqqq')
+_INDEX_ENTRY = struct.Struct('<qq')
+
+
+def available_codecs():
+    '''
+    Returns the names of the installed decompression backends, fastest first.
+    '''
+
+    return [name for name, module in CODECS.items() if module is not None]
+
+def set_codec(name=None):
+    '''
+    Selects the decompression backend used by everything in this module, the fastest installed one if name is None.
+    All of them produce identical output, they only differ in speed. Returns the name of the selected backend.
+    '''
+
+    global _codec, _codec_name
+    if name is None:
+        name = available_codecs()[0]
+    if CODECS.get(name) is None:
+        raise ValueError("Codec {} is not available, installed: {}".format(name, ", ".join(available_codecs())))
+    _codec = CODECS[name]
+    _codec_name = name
+    logging.debug("Using codec {}".format(name))
+    return name
+
+def get_codec():
+    '''
+    Returns the name of the selected decompression backend.
+    '''
+
+    return _codec_name
+
+def _corrupt(msg):
+    logging.critical(msg)
+    raise CorruptUnpackException(msg)
+
+def _read_exact(f, size):
+    data = f.read(size)
+    if len(data) != size:
+        _corrupt("Archive is truncated: expected {} more bytes but only {} were available.".format(size, len(data)))
+    return data
+
+def _read_header(f):
+    '''
+    Reads and validates the 32 byte archive header.
+
+    Returns a tuple (size_unpacked_chunk, size_packed, size_unpacked).
+    '''
+    raw = _read_exact(f, _HEADER.size)
+    sigver, size_unpacked_chunk, size_packed, size_unpacked = _HEADER.unpack(raw)
+
+    if sigver != ARCHIVE_SIGNATURE:
+        msg = "The signature and format version is incorrect. Signature was {} should be {}.".format(sigver, ARCHIVE_SIGNATURE)
+        logging.critical(msg)
+        raise SignatureUnpackException(msg)
+
+    if size_unpacked_chunk < 0 or size_packed < 0 or size_unpacked < 0:
+        _corrupt("Sizes in the header should not be negative. Unpacked Chunk: {} Full Packed: {} Full Unpacked: {}".format(size_unpacked_chunk, size_packed, size_unpacked))
+
+    logging.info("Archive is valid.")
+    logging.debug("Archive header size information. Unpacked Chunk: {} Full Packed: {} Full Unpacked: {}".format(size_unpacked_chunk, size_packed, size_unpacked))
+    return size_unpacked_chunk, size_packed, size_unpacked
+
+def _read_index(f, size_unpacked_chunk, size_unpacked):
+    '''
+    Reads the compression index which directly follows the header.
+
+    The index is read in one go, sized by the number of chunks the header announces but never more than the rest
+    of the file could hold, so a corrupt header cannot make it allocate more than the archive's size, and returned
+    as a flat array('q') of alternating compressed/uncompressed sizes. Entries are read until they add up to the full
+    unpacked size, exactly as ARK does, so archives with an unexpected chunk layout still work.
+    '''
+    index = array.array('q')
+    if size_unpacked == 0:
+        return index
+
+    start = f.tell()
+    expected = -(-size_unpacked // size_unpacked_chunk) if size_unpacked_chunk > 0 else 1
+    expected = min(expected, max(os.fstat(f.fileno()).st_size - start, 0) // _INDEX_ENTRY.size)
+    raw = f.read(expected * _INDEX_ENTRY.size)
+    raw = raw[:len(raw) - len(raw) % _INDEX_ENTRY.size]
+    index.frombytes(raw)
+    if sys.byteorder != 'little':
+        index.byteswap()
+
+    #Only keep the entries up to the one completing the unpacked size
+    size_indexed = 0
+    for i in range(1, len(index), 2):
+        size_indexed += index[i]
+        if size_indexed >= size_unpacked:
+            del index[i + 1:]
+            f.seek(start + len(index) * 8)
+            break
+    else:
+        while size_indexed < size_unpacked:
+            compressed, uncompressed = _INDEX_ENTRY.unpack(_read_exact(f, _INDEX_ENTRY.size))
+            index.append(compressed)
+            index.append(uncompressed)
+            size_indexed += uncompressed
+
+    logging.debug("Index contains {} chunks for {}/{} bytes".format(len(index) // 2, size_indexed, size_unpacked))
+
+    if size_unpacked != size_indexed:
+        _corrupt("Header-Index mismatch. Header indicates it should only have {} bytes when uncompressed but the index indicates {} bytes.".format(size_unpacked, size_indexed))
+
+    for i in range(0, len(index), 2):
+        if index[i] < 0 or index[i + 1] < 0:
+            _corrupt("Index contains a negative chunk size at chunk {}/{}.".format(i // 2 + 1, len(index) // 2))
+
+    return index
+
+def _check_chunk(uncompressed_size, expected, size_unpacked_chunk, chunk, chunks):
+    #Verify the size of the data is consistent with the archives index
+    if uncompressed_size != expected:
+        _corrupt("Uncompressed chunk size is not the same as in the index: was {} but should be {}.".format(uncompressed_size, expected))
+
+    #Verify there is only one partial chunk
+    if uncompressed_size != size_unpacked_chunk and chunk != chunks:
+        _corrupt("Index contains more than one partial chunk: was {} when the full chunk size is {}, chunk {}/{}".format(uncompressed_size, size_unpacked_chunk, chunk, chunks))
+
+def _chunk_digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def _preallocate(f_out, size):
+    f_out.flush()
+    try:
+        os.posix_fallocate(f_out.fileno(), 0, size)
+    except (AttributeError, OSError):
+        f_out.truncate(size)
+
+def _decompress_chunk(data, uncompressed, size_unpacked_chunk, chunk, chunks):
+    try:
+        uncompressed_data = _codec.decompress(data, zlib.MAX_WBITS, max(uncompressed, 1))
+    except _codec.error as e:
+        _corrupt("Chunk {}/{} could not be decompressed: {}".format(chunk, chunks, e))
+    _check_chunk(len(uncompressed_data), uncompressed, size_unpacked_chunk, chunk, chunks)
+    return uncompressed_data
+
+class _Checkpoints(object):
+    '''
+    Collects the CRC-32 of finished chunks, which may finish out of order, and hands every contiguous run of at least
+    checkpoint_bytes unpacked bytes, and the rest at the end, to the checkpoint callable of unpack.
+    '''
+
+    def __init__(self, checkpoint, compression_index, first, checkpoint_bytes, flush):
+        self._checkpoint = checkpoint
+        self._compression_index = compression_index
+        self._chunks = len(compression_index) // 2
+        self._checkpoint_bytes = checkpoint_bytes
+        self._flush = flush
+        self._crcs = {}
+        self._reported = first
+        self._ready = first
+        self._bytes = 0
+
+    def finished(self, chunk, crc):
+        self._crcs[chunk - 1] = crc
+        while self._ready in self._crcs:
+            self._bytes += self._compression_index[self._ready * 2 + 1]
+            self._ready += 1
+        if self._ready > self._reported and (self._bytes >= self._checkpoint_bytes or self._ready == self._chunks):
+            #Everything reported has to be in the file, at least as far as the kernel is concerned
+            self._flush()
+            self._checkpoint(self._reported, [self._crcs.pop(index) for index in range(self._reported, self._ready)])
+            self._reported = self._ready
+            self._bytes = 0
+
+def _unpack_serial(f, f_out, compression_index, size_unpacked_chunk, buffer_size, progress, first, checkpoints, digests):
+    chunks = len(compression_index) // 2
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    for chunk in range(first + 1, chunks + 1):
+        compressed = compression_index[chunk * 2 - 2]
+        uncompressed = compression_index[chunk * 2 - 1]
+
+        #Common case, the whole chunk fits the buffer: one read and one exactly sized decompression
+        if compressed <= buffer_size and uncompressed <= buffer_size:
+            if f.readinto(view[:compressed]) != compressed:
+                _corrupt("Archive is truncated: chunk {}/{} is incomplete.".format(chunk, chunks))
+            #Write the extracted data to disk
+            uncompressed_data = _decompress_chunk(view[:compressed], uncompressed, size_unpacked_chunk, chunk, chunks)
+            f_out.write(uncompressed_data)
+            if progress is not None:
+                progress(uncompressed)
+            if checkpoints is not None:
+                checkpoints.finished(chunk, zlib.crc32(uncompressed_data))
+            if digests is not None:
+                digests.append((_chunk_digest(view[:compressed]), uncompressed))
+            continue
+
+        decompressor = _codec.decompressobj()
+        hasher = hashlib.blake2b(digest_size=16) if digests is not None else None
+        produced = 0
+        crc = 0
+        remaining = compressed
+        try:
+            while remaining:
+                read = f.readinto(view[:min(remaining, buffer_size)])
+                if not read:
+                    _corrupt("Archive is truncated: chunk {}/{} is missing {} bytes.".format(chunk, chunks, remaining))
+                remaining -= read
+                data = view[:read]
+                if hasher is not None:
+                    hasher.update(data)
+                #Drain until the input is used up and zlib has no more pending output for it
+                while not decompressor.eof:
+                    uncompressed_data = decompressor.decompress(data, buffer_size)
+                    produced += len(uncompressed_data)
+                    if produced > uncompressed:
+                        _corrupt("Uncompressed chunk size is larger than in the index: chunk {}/{} should be {}.".format(chunk, chunks, uncompressed))
+                    #Write the extracted data to disk
+                    f_out.write(uncompressed_data)
+                    if progress is not None and uncompressed_data:
+                        progress(len(uncompressed_data))
+                    if checkpoints is not None:
+                        crc = zlib.crc32(uncompressed_data, crc)
+                    data = decompressor.unconsumed_tail
+                    if not data and len(uncompressed_data) < buffer_size:
+                        break
+        except _codec.error as e:
+            _corrupt("Chunk {}/{} could not be decompressed: {}".format(chunk, chunks, e))
+        if not decompressor.eof:
+            _corrupt("Chunk {}/{} ends before its compressed stream is complete.".format(chunk, chunks))
+
+        _check_chunk(produced, uncompressed, size_unpacked_chunk, chunk, chunks)
+        if checkpoints is not None:
+            checkpoints.finished(chunk, crc)
+        if hasher is not None:
+            digests.append((hasher.hexdigest(), uncompressed))
+
+def _pwrite_all(fd, data, offset):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+def _unpack_parallel(f, f_out, compression_index, size_unpacked_chunk, workers, progress, first, checkpoints, digests):
+    '''
+    Decompresses the chunks on a thread pool. All codecs release the GIL, so this scales with cores.
+    Every worker reads its chunk with pread() and writes it with pwrite() at the offset precomputed
+    from the index, so the output does not depend on completion order. At most two chunks per worker
+    are in flight to keep the memory bounded.
+    '''
+    chunks = len(compression_index) // 2
+    src_fd = f.fileno()
+    dst_fd = f_out.fileno()
+    f_out.flush()
+    if digests is not None:
+        #Workers fill in their own slot, so the digests stay in chunk order
+        base = len(digests) - first
+        digests.extend([None] * (chunks - first))
+
+    def work(chunk, src_offset, dst_offset):
+        compressed = compression_index[chunk * 2 - 2]
+        uncompressed = compression_index[chunk * 2 - 1]
+        data = os.pread(src_fd, compressed, src_offset)
+        if len(data) != compressed:
+            _corrupt("Archive is truncated: chunk {}/{} is incomplete.".format(chunk, chunks))
+        uncompressed_data = _decompress_chunk(data, uncompressed, size_unpacked_chunk, chunk, chunks)
+        _pwrite_all(dst_fd, uncompressed_data, dst_offset)
+        if progress is not None:
+            progress(uncompressed)
+        if digests is not None:
+            digests[base + chunk - 1] = (_chunk_digest(data), uncompressed)
+        return chunk, zlib.crc32(uncompressed_data) if checkpoints is not None else None
+
+    def finished(future):
+        chunk, crc = future.result()
+        if checkpoints is not None:
+            checkpoints.finished(chunk, crc)
+
+    src_offset = f.tell()
+    dst_offset = sum(compression_index[1:first * 2:2])
+    pending = set()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for chunk in range(first + 1, chunks + 1):
+                if len(pending) >= workers * 2:
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        finished(future)
+                pending.add(executor.submit(work, chunk, src_offset, dst_offset))
+                src_offset += compression_index[chunk * 2 - 2]
+                dst_offset += compression_index[chunk * 2 - 1]
+            for future in concurrent.futures.as_completed(pending):
+                finished(future)
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+
+def unpack(src, dst, buffer_size=DEFAULT_BUFFER_SIZE, workers=1, parallel_threshold=DEFAULT_PARALLEL_THRESHOLD, progress=None, resume=0, checkpoint=None, checkpoint_bytes=DEFAULT_CHECKPOINT_BYTES, digests=None):
     '''
     Unpacks ARK's Steam Workshop *.z archives.
 
-    Accepts two arguments:
+    Accepts these arguments:
         src = Source File/Archive
         dst = Destination File
+        buffer_size = Upper bound in bytes for the read buffer and every piece of decompressed output (optional)
+        workers = Number of threads decompressing chunks in parallel, 1 is serial, None uses all cores (optional)
+        parallel_threshold = Archives with fewer unpacked bytes than this are always unpacked serially (optional)
+        progress = Callable receiving the number of bytes just decompressed and written, after every chunk or piece of one;
+                   in parallel mode it is called from the worker threads (optional)
+        resume = Number of leading chunks already unpacked into dst by an interrupted unpack; they are kept as they are (optional)
+        checkpoint = Callable receiving (first chunk, list of CRC-32s) for every run of finished chunks of at least
+                     checkpoint_bytes, and the rest at the end, in order and once the data is written (optional)
+        checkpoint_bytes = Unpacked bytes between two checkpoints (optional)
+        digests = List that receives a (digest, unpacked size) pair for every chunk of the archive in order, resumed ones
+                  included, where digest is the BLAKE2b hash of the compressed chunk; what patch needs as base_chunks (optional)
+
+    Returns an UnpackStats tuple with the number of chunks, the bytes read from the archive and the bytes written,
+    not counting resumed chunks.
 
     Error Handling:
         Currently logs errors via logging with an archive integrity as well as raising a custom exception. Also logs some debug and info messages.
@@ -62,78 +404,448 @@ def unpack(src, dst):
         2. Read all the archive data and verify integrity (there should only be one partial chunk, and each chunk should match the archives header).
         3. Write the file.
 
+    Memory:
+        The index is read in bulk into a compact array. Chunk data is streamed through one preallocated buffer of
+        buffer_size bytes with readinto() and decompressed in pieces of at most buffer_size bytes, so the memory
+        used stays the same no matter how big the archive or its chunks are. The destination is preallocated to
+        the full unpacked size up front.
+
+    Codec:
+        Chunks are decompressed with the backend selected by set_codec, by default the fastest installed one
+        of isal, zlib-ng and stdlib zlib.
+
+    Parallel Mode:
+        With more than one worker, archives of at least parallel_threshold bytes whose chunks all fit into
+        buffer_size are decompressed on a thread pool and written at their precomputed offsets. The memory
+        ceiling then grows to about 4 * workers * buffer_size. Everything else is unpacked serially, where
+        the pool overhead would dominate.
+
     Development Note:
         - Not thoroughly tested for errors. There may be instances where this method may fail either to extract a valid archive or detect a corrupt archive.
         - Prevent overwriting files unless requested to do so.
         - Create a batch method.
     '''
 
-    with open(src, 'rb') as f:
-        sigver = struct.unpack('q', f.read(8))[0]
-        unpacked_chunk = f.read(8)
-        packed = f.read(8)
-        unpacked = f.read(8)
-        size_unpacked_chunk = struct.unpack('q', unpacked_chunk)[0]
-        size_packed = struct.unpack('q', packed)[0]
-        size_unpacked = struct.unpack('q', unpacked)[0]
-
-        #Verify the integrity of the Archive Header
-        if sigver == 2653586369:
-            if isinstance(size_unpacked_chunk, int) and isinstance(size_packed , int) and isinstance(size_unpacked , int):
-                logging.info("Archive is valid.")
-                logging.debug("Archive header size information. Unpacked Chunk: {}({}) Full Packed: {}({}) Full Unpacked: {}({})".format(size_unpacked_chunk, unpacked_chunk, size_packed, packed, size_unpacked, unpacked))
-
-                #Obtain the Archive Compression Index
-                compression_index = []
-                size_indexed = 0
-                while size_indexed < size_unpacked:
-                    raw_compressed = f.read(8)
-                    raw_uncompressed = f.read(8)
-                    compressed = struct.unpack('q', raw_compressed)[0]
-                    uncompressed = struct.unpack('q', raw_uncompressed)[0]
-                    compression_index.append((compressed, uncompressed))
-                    size_indexed += uncompressed
-                    logging.debug("{}: {}/{} ({}/{}) - {} - {}".format(len(compression_index), size_indexed, size_unpacked, compressed, uncompressed, raw_compressed, raw_uncompressed))
-
-                if size_unpacked != size_indexed:
-                    msg = "Header-Index mismatch. Header indicates it should only have {} bytes when uncompressed but the index indicates {} bytes.".format(size_unpacked, size_indexed)
-                    logging.critical(msg)
-                    raise CorruptUnpackException(msg)
-
-                #Read the actual archive data
-                data = b''
-                read_data = 0
-                f_out = open(dst, 'wb')
-                for compressed, uncompressed in compression_index:
-                    compressed_data = f.read(compressed)
-                    uncompressed_data = zlib.decompress(compressed_data)
-
-                    #Verify the size of the data is consistent with the archives index
-                    if len(uncompressed_data) == uncompressed:
-                      #Write the extracted data to disk
-                      f_out.write(uncompressed_data)
-                      read_data += 1
-
-                      #Verify there is only one partial chunk
-                      if len(uncompressed_data) != size_unpacked_chunk and read_data != len(compression_index):
-                            f_out.close()
-                            msg = "Index contains more than one partial chunk: was {} when the full chunk size is {}, chunk {}/{}".format(len(uncompressed_data), size_unpacked_chunk, read_data, len(compression_index))
-                            logging.critical(msg)
-                            raise CorruptUnpackException(msg)
-                    else:
-                        f_out.close()
-                        msg = "Uncompressed chunk size is not the same as in the index: was {} but should be {}.".format(len(uncompressed_data), uncompressed)
-                        logging.critical(msg)
-                        raise CorruptUnpackException(msg)
-            
-                f_out.close()
-            else:
-                msg = "Data types in the headers should be int's. Size Types: unpacked_chunk({}), packed({}), unpacked({})".format(sigver, type(size_unpacked_chunk), type(size_packed), type(size_unpacked))
-                logging.critical(msg)
-                raise CorruptUnpackException(msg)
+    buffer_size = max(int(buffer_size), 4096)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    with io.open(src, 'rb') as f:
+        size_unpacked_chunk, size_packed, size_unpacked = _read_header(f)
+
+        #Obtain the Archive Compression Index
+        compression_index = _read_index(f, size_unpacked_chunk, size_unpacked)
+        chunks = len(compression_index) // 2
+        if not 0 <= resume <= chunks:
+            raise ValueError("resume must be between 0 and {}, was {}".format(chunks, resume))
+
+        parallel = workers > 1 and chunks - resume > 1 and size_unpacked >= parallel_threshold and max(compression_index) <= buffer_size
+
+        #Read the actual archive data, after the chunks already unpacked
+        if digests is None:
+            f.seek(sum(compression_index[0:resume * 2:2]), io.SEEK_CUR)
         else:
-            msg = "The signature and format version is incorrect. Signature was {} should be 2653586369.".format(sigver)
-            logging.critical(msg)
-            raise SignatureUnpackException(msg)
+            for chunk in range(resume):
+                digests.append((_chunk_digest(_read_exact(f, compression_index[chunk * 2])), compression_index[chunk * 2 + 1]))
+        with io.open(dst, 'r+b' if resume else 'wb') as f_out:
+            _preallocate(f_out, size_unpacked)
+            f_out.seek(sum(compression_index[1:resume * 2:2]))
+            checkpoints = None
+            if checkpoint is not None:
+                checkpoints = _Checkpoints(checkpoint, compression_index, resume, checkpoint_bytes, f_out.flush)
+            if parallel:
+                logging.debug("Unpacking {} chunks with {} workers".format(chunks - resume, workers))
+                _unpack_parallel(f, f_out, compression_index, size_unpacked_chunk, workers, progress, resume, checkpoints, digests)
+            else:
+                _unpack_serial(f, f_out, compression_index, size_unpacked_chunk, buffer_size, progress, resume, checkpoints, digests)
 
     logging.info("Archive has been extracted.")
+    bytes_read = _HEADER.size + len(compression_index) * 8 + sum(compression_index[resume * 2::2])
+    return UnpackStats(chunks - resume, bytes_read, sum(compression_index[resume * 2 + 1::2]))
+
+def _copy_range(src_fd, dst_fd, count, src_offset, dst_offset):
+    #Inside the kernel if possible, which lets file systems with reflinks share the blocks
+    try:
+        while count:
+            copied = os.copy_file_range(src_fd, dst_fd, count, src_offset, dst_offset)
+            if not copied:
+                break
+            count -= copied
+            src_offset += copied
+            dst_offset += copied
+    except (AttributeError, OSError):
+        pass
+    while count:
+        data = os.pread(src_fd, min(count, DEFAULT_BUFFER_SIZE), src_offset)
+        if not data:
+            raise ValueError("base ends {} bytes before its chunks do".format(count))
+        _pwrite_all(dst_fd, data, dst_offset)
+        count -= len(data)
+        src_offset += len(data)
+        dst_offset += len(data)
+
+def patch(src, dst, base, base_chunks, workers=1, progress=None, digests=None):
+    '''
+    Unpacks an archive by reusing base, the file unpacked from an earlier version of the same archive.
+
+    Accepts these arguments:
+        src = Source File/Archive
+        dst = Destination File, a new file that must not be base
+        base = File unpacked from the earlier version
+        base_chunks = The (digest, unpacked size) pairs unpack or patch reported in digests for the earlier version
+        workers = Number of threads decompressing the changed chunks, 1 is serial, None uses all cores (optional)
+        progress = Callable receiving the number of bytes just decompressed and written (optional)
+        digests = List that receives the (digest, unpacked size) pairs of src, for the next patch (optional)
+
+    Returns an UnpackStats tuple with the number of chunks decompressed, the bytes read from the archive and the
+    bytes decompressed and written; the rest of dst was copied from base.
+
+    Process:
+        1. Read the header and the compression index, validated as by unpack.
+        2. Hash every compressed chunk. A chunk with the same hash as a chunk of base_chunks has the same content,
+           so it is copied from base at that chunk's offset, even if it moved, with runs of chunks copied at once.
+        3. Decompress the other chunks and write them at their offsets in dst, checked as by unpack.
+
+    Nothing of base is decompressed again, so the cost of an update depends on how much of the archive changed.
+    The size of base has to match base_chunks, otherwise ValueError is raised before dst is touched.
+    '''
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    #Where every chunk of the earlier version is in base
+    base_offsets = {}
+    base_size = 0
+    for digest, size in base_chunks:
+        base_offsets.setdefault(digest, (base_size, size))
+        base_size += size
+
+    with io.open(src, 'rb') as f, io.open(base, 'rb') as f_base:
+        if os.fstat(f_base.fileno()).st_size != base_size:
+            raise ValueError("base has {} bytes but base_chunks add up to {}".format(os.fstat(f_base.fileno()).st_size, base_size))
+        size_unpacked_chunk, size_packed, size_unpacked = _read_header(f)
+        compression_index = _read_index(f, size_unpacked_chunk, size_unpacked)
+        chunks = len(compression_index) // 2
+
+        with io.open(dst, 'wb') as f_out:
+            f_out.truncate(size_unpacked)
+            base_fd = f_base.fileno()
+            dst_fd = f_out.fileno()
+
+            def work(data, uncompressed, chunk, dst_offset):
+                uncompressed_data = _decompress_chunk(data, uncompressed, size_unpacked_chunk, chunk, chunks)
+                _pwrite_all(dst_fd, uncompressed_data, dst_offset)
+                if progress is not None:
+                    progress(uncompressed)
+
+            decompressed = 0
+            bytes_written = 0
+            run = None
+            dst_offset = 0
+            pending = set()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                try:
+                    for chunk in range(1, chunks + 1):
+                        compressed = compression_index[chunk * 2 - 2]
+                        uncompressed = compression_index[chunk * 2 - 1]
+                        data = _read_exact(f, compressed)
+                        digest = _chunk_digest(data)
+                        if digests is not None:
+                            digests.append((digest, uncompressed))
+
+                        found = base_offsets.get(digest)
+                        if found is not None and found[1] == uncompressed:
+                            _check_chunk(uncompressed, uncompressed, size_unpacked_chunk, chunk, chunks)
+                            #Extend the run of copied chunks if this one follows it in base as well as in dst
+                            if run is not None and run[0] + run[2] == found[0] and run[1] + run[2] == dst_offset:
+                                run[2] += uncompressed
+                            else:
+                                if run is not None:
+                                    _copy_range(base_fd, dst_fd, run[2], run[0], run[1])
+                                run = [found[0], dst_offset, uncompressed]
+                        else:
+                            decompressed += 1
+                            bytes_written += uncompressed
+                            if workers > 1:
+                                if len(pending) >= workers * 2:
+                                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                                    for future in done:
+                                        future.result()
+                                pending.add(executor.submit(work, data, uncompressed, chunk, dst_offset))
+                            else:
+                                work(data, uncompressed, chunk, dst_offset)
+                        dst_offset += uncompressed
+                    if run is not None:
+                        _copy_range(base_fd, dst_fd, run[2], run[0], run[1])
+                    for future in concurrent.futures.as_completed(pending):
+                        future.result()
+                except BaseException:
+                    for future in pending:
+                        future.cancel()
+                    raise
+
+    logging.info("Archive has been patched: {}/{} chunks decompressed.".format(decompressed, chunks))
+    return UnpackStats(decompressed, _HEADER.size + len(compression_index) * 8 + sum(compression_index[0::2]), bytes_written)
+
+def unpacked_crcs(src, dst, chunks=None):
+    '''
+    Computes the CRC-32 of every chunk of an unpacked file, at the chunk boundaries from the archive's index, as
+    unpack reports them to checkpoint, e.g. to check the output of an interrupted unpack before resuming it.
+
+    Returns a list with the CRC-32s of the first chunks chunks (all by default), shorter if dst ends before.
+    '''
+
+    sizes = read_info(src).compression_index[1::2]
+    if chunks is not None:
+        sizes = sizes[:chunks]
+    crcs = []
+    with io.open(dst, 'rb') as f:
+        for size in sizes:
+            data = f.read(size)
+            if len(data) != size:
+                break
+            crcs.append(zlib.crc32(data))
+    return crcs
+
+def read_info(src):
+    '''
+    Reads only the header and the compression index of an archive, without decompressing anything.
+
+    Validates everything unpack can know before decompressing: the signature, the header sizes, that the index adds up
+    to the unpacked size, that there is only one partial chunk and that the archive is long enough for all chunks.
+
+    Returns an ArchiveInfo tuple; compression_index is the flat array of alternating compressed/uncompressed sizes
+    and data_offset the position of the first chunk.
+    '''
+
+    with io.open(src, 'rb') as f:
+        size_unpacked_chunk, size_packed, size_unpacked = _read_header(f)
+        compression_index = _read_index(f, size_unpacked_chunk, size_unpacked)
+        data_offset = f.tell()
+        size = os.fstat(f.fileno()).st_size
+
+    chunks = len(compression_index) // 2
+    for chunk in range(1, chunks + 1):
+        uncompressed = compression_index[chunk * 2 - 1]
+        _check_chunk(uncompressed, uncompressed, size_unpacked_chunk, chunk, chunks)
+
+    size_expected = data_offset + sum(compression_index[0::2])
+    if size < size_expected:
+        _corrupt("Archive is truncated: the index needs {} bytes but the archive only has {}.".format(size_expected, size))
+
+    return ArchiveInfo(size_unpacked_chunk, size_packed, size_unpacked, data_offset, compression_index)
+
+def iter_unpack(src, workers=1):
+    '''
+    Decompresses an archive chunk by chunk without writing anything and yields the chunks in order.
+
+    Every chunk is checked like in unpack. With more than one worker the chunks are decompressed on a thread pool,
+    at most two per worker ahead of the consumer, and still yielded in order, e.g. to feed a hash.
+    '''
+
+    info = read_info(src)
+    compression_index = info.compression_index
+    chunks = len(compression_index) // 2
+
+    with io.open(src, 'rb') as f:
+        fd = f.fileno()
+
+        def work(chunk, offset):
+            compressed = compression_index[chunk * 2 - 2]
+            data = os.pread(fd, compressed, offset)
+            if len(data) != compressed:
+                _corrupt("Archive is truncated: chunk {}/{} is incomplete.".format(chunk, chunks))
+            return _decompress_chunk(data, compression_index[chunk * 2 - 1], info.chunk_size, chunk, chunks)
+
+        offsets = []
+        offset = info.data_offset
+        for chunk in range(1, chunks + 1):
+            offsets.append(offset)
+            offset += compression_index[chunk * 2 - 2]
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers <= 1 or chunks <= 1:
+            for chunk in range(1, chunks + 1):
+                yield work(chunk, offsets[chunk - 1])
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = collections.deque()
+            try:
+                for chunk in range(1, chunks + 1):
+                    pending.append(executor.submit(work, chunk, offsets[chunk - 1]))
+                    if len(pending) >= workers * 2:
+                        yield pending.popleft().result()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+class ArchiveReader(io.RawIOBase):
+    '''
+    Read-only, seekable file object over the unpacked content of an archive, see open.
+
+    The chunk boundaries are kept in two compact array('q') tables of packed and unpacked offsets, so looking up the
+    chunk of a position is a bisection. Chunks are decompressed on demand and the most recently used ones are kept
+    in a small LRU cache.
+    '''
+
+    def __init__(self, src, use_mmap=False, cache_chunks=DEFAULT_CACHE_CHUNKS):
+        super().__init__()
+        info = read_info(src)
+        self.name = src
+        self._chunk_size = info.chunk_size
+        self._size = info.size_unpacked
+        self._position = 0
+        self._cache = collections.OrderedDict()
+        self._cache_chunks = max(int(cache_chunks), 1)
+
+        compression_index = info.compression_index
+        self._chunks = len(compression_index) // 2
+        self._packed_offsets = array.array('q', [info.data_offset])
+        self._unpacked_offsets = array.array('q', [0])
+        for chunk in range(self._chunks):
+            self._packed_offsets.append(self._packed_offsets[-1] + compression_index[chunk * 2])
+            self._unpacked_offsets.append(self._unpacked_offsets[-1] + compression_index[chunk * 2 + 1])
+
+        self._file = io.open(src, 'rb')
+        self._mmap = None
+        if use_mmap and self._packed_offsets[-1] > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        self._checkClosed()
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._checkClosed()
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self._size + offset
+        else:
+            raise ValueError("invalid whence ({}, should be 0, 1 or 2)".format(whence))
+        if position < 0:
+            raise ValueError("negative seek position {}".format(position))
+        self._position = position
+        return position
+
+    def readinto(self, b):
+        self._checkClosed()
+        view = memoryview(b).cast('B')
+        filled = 0
+        while filled < len(view) and self._position < self._size:
+            chunk = bisect.bisect_right(self._unpacked_offsets, self._position) - 1
+            data = self._chunk(chunk)
+            start = self._position - self._unpacked_offsets[chunk]
+            length = min(len(view) - filled, len(data) - start)
+            view[filled:filled + length] = data[start:start + length]
+            filled += length
+            self._position += length
+        return filled
+
+    def close(self):
+        if not self.closed:
+            if self._mmap is not None:
+                self._mmap.close()
+            self._file.close()
+            self._cache.clear()
+        super().close()
+
+    def _chunk(self, chunk):
+        data = self._cache.get(chunk)
+        if data is not None:
+            self._cache.move_to_end(chunk)
+            return data
+
+        start = self._packed_offsets[chunk]
+        compressed = self._packed_offsets[chunk + 1] - start
+        if self._mmap is not None:
+            compressed_data = memoryview(self._mmap)[start:start + compressed]
+        else:
+            compressed_data = os.pread(self._file.fileno(), compressed, start)
+        try:
+            data = _decompress_chunk(compressed_data, self._unpacked_offsets[chunk + 1] - self._unpacked_offsets[chunk], self._chunk_size, chunk + 1, self._chunks)
+        finally:
+            if isinstance(compressed_data, memoryview):
+                compressed_data.release()
+
+        self._cache[chunk] = data
+        if len(self._cache) > self._cache_chunks:
+            self._cache.popitem(last=False)
+        return data
+
+def open(src, use_mmap=False, cache_chunks=DEFAULT_CACHE_CHUNKS):
+    '''
+    Opens an archive for random access reads of its unpacked content without extracting it.
+
+    Accepts three arguments:
+        src = Source File/Archive
+        use_mmap = Map the archive into memory instead of reading chunks with pread (optional)
+        cache_chunks = Number of decompressed chunks kept in the LRU cache (optional)
+
+    Returns a read-only, seekable ArchiveReader (io.RawIOBase). Seeking is free, every read only decompresses the
+    chunks it touches. Wrap it in io.BufferedReader for small reads, or copy it into a hash or another file with
+    shutil.copyfileobj without a temporary file.
+    '''
+
+    return ArchiveReader(src, use_mmap, cache_chunks)
+
+def pack(src, dst, chunk_size=DEFAULT_CHUNK_SIZE, level=zlib.Z_DEFAULT_COMPRESSION):
+    '''
+    Packs a file into ARK's Steam Workshop *.z archive format, the counterpart of unpack.
+
+    Accepts four arguments:
+        src = Source File
+        dst = Destination File/Archive
+        chunk_size = Unpacked/uncompressed size of every chunk but the last (optional)
+        level = zlib compression level of the chunks (optional)
+
+    Process:
+        1. Reserve room for the header and the compression index, one entry per chunk.
+        2. Compress the source chunk by chunk, every chunk as its own zlib stream, and write them in order.
+        3. Write the header (signature, chunk size, packed size, unpacked size) and the index in front of the data.
+
+    Only one chunk is held in memory at a time. Chunks are always compressed with stdlib zlib, whatever codec is selected.
+    '''
+
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be positive, was {}".format(chunk_size))
+
+    size_unpacked = os.path.getsize(src)
+    chunks = -(-size_unpacked // chunk_size)
+    compression_index = array.array('q')
+
+    with io.open(src, 'rb') as f, io.open(dst, 'wb') as f_out:
+        f_out.seek(_HEADER.size + chunks * _INDEX_ENTRY.size)
+        size_packed = 0
+        for chunk in range(chunks):
+            data = f.read(chunk_size)
+            compressed_data = zlib.compress(data, level)
+            f_out.write(compressed_data)
+            compression_index.append(len(compressed_data))
+            compression_index.append(len(data))
+            size_packed += len(compressed_data)
+
+        if sum(compression_index[1::2]) != size_unpacked:
+            raise PackException("Source file {} changed while it was packed.".format(src))
+        if sys.byteorder != 'little':
+            compression_index.byteswap()
+
+        f_out.seek(0)
+        f_out.write(_HEADER.pack(ARCHIVE_SIGNATURE, chunk_size, size_packed, size_unpacked))
+        f_out.write(compression_index.tobytes())
+
+    logging.info("Archive has been packed.")
+
+set_codec()
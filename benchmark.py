@@ -0,0 +1,489 @@
+#!/usr/bin/python3
+"""
+Benchmarks for the .z extraction path.
+
+unpack compares arkit.unpack implementations on one archive, mod generates a synthetic mod with arkit.pack and
+measures arkit.unpack, ModDodo.extract_mod and a full ModDodo install on it, codecs compares the installed
+decompression backends on the chunks of real (or synthetic) .z files, governor measures extraction throughput
+against the lag of a simulated game server for several ResourceGovernor settings.
+
+Every measurement runs in a fresh interpreter so the reported peak RSS belongs to that run alone.
+"""
+
+import arkit
+import argparse
+import json
+import moddodo
+import os
+import random
+import resource
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from collections import OrderedDict
+
+
+def legacy_unpack(src, dst):
+    """
+    The original arkit.unpack loop: two reads per index entry and one zlib.decompress per chunk.
+    Kept here as the baseline to compare against.
+    """
+    with open(src, 'rb') as f:
+        f.read(8)
+        f.read(8)
+        f.read(8)
+        size_unpacked = struct.unpack('q', f.read(8))[0]
+        compression_index = []
+        size_indexed = 0
+        while size_indexed < size_unpacked:
+            compressed = struct.unpack('q', f.read(8))[0]
+            uncompressed = struct.unpack('q', f.read(8))[0]
+            compression_index.append((compressed, uncompressed))
+            size_indexed += uncompressed
+        with open(dst, 'wb') as f_out:
+            for compressed, uncompressed in compression_index:
+                f_out.write(zlib.decompress(f.read(compressed)))
+
+
+def synthetic_block(seed=0):
+    """
+    Deterministic, moderately compressible data, roughly like cooked UE4 assets.
+    """
+    return bytes((i * 31 + seed) & 0xff for i in range(4096)) + random.Random(seed).randbytes(1024)
+
+
+def write_synthetic(path, size, seed=0):
+    """
+    Write size bytes of synthetic data without holding them in memory.
+    """
+    block = synthetic_block(seed) * 256
+    with open(path, "wb") as f:
+        remaining = size
+        while remaining:
+            f.write(block[:remaining])
+            remaining -= min(remaining, len(block))
+
+
+def write_archive(path, size, chunk_size=arkit.DEFAULT_CHUNK_SIZE, level=6, seed=0):
+    raw = path + ".raw"
+    write_synthetic(raw, size, seed)
+    try:
+        arkit.pack(raw, path, chunk_size, level)
+    finally:
+        os.remove(raw)
+
+
+def write_ue4_string(f, string):
+    data = string.encode("utf-8") + b"\0"
+    f.write(struct.pack("i", len(data)))
+    f.write(data)
+
+
+# (file count, unpacked size in bytes) per synthetic mod profile, sizes are multiplied by --scale
+PROFILES = {
+    "tiny": [(2000, 16 * 1024)],
+    "mixed": [(300, 256 * 1024), (40, 4 * 1024 * 1024), (4, 64 * 1024 * 1024)],
+    "huge": [(2, 2 * 1024 * 1024 * 1024)],
+}
+
+
+def generate_mod(root, modid, profile, scale=1.0, chunk_size=arkit.DEFAULT_CHUNK_SIZE, level=6):
+    """
+    Generate a synthetic downloaded mod in root/content/<modid> as SteamCMD leaves it: the WindowsNoEditor tree with
+    .z archives and .uncompressed_size files, mod.info and modmeta.info. Also creates an empty server in root/server.
+    :returns (number of archives, total unpacked bytes)
+    """
+    srcdir = os.path.join(root, "content", modid, "WindowsNoEditor")
+    os.makedirs(srcdir, exist_ok=True)
+    os.makedirs(os.path.join(root, "server", "ShooterGame", "Content"), exist_ok=True)
+
+    with open(os.path.join(srcdir, "mod.info"), "wb") as f:
+        write_ue4_string(f, "Benchmark")
+        f.write(struct.pack("i", 1))
+        write_ue4_string(f, "BenchmarkMap")
+    with open(os.path.join(srcdir, "modmeta.info"), "wb") as f:
+        f.write(struct.pack("i", 1))
+        write_ue4_string(f, "ModType")
+        write_ue4_string(f, "1")
+
+    files = 0
+    total = 0
+    for count, size in PROFILES[profile]:
+        size = max(int(size * scale), 1)
+        for i in range(count):
+            directory = os.path.join(srcdir, "Content", "Assets{}".format(files % 16))
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, "Asset{}.uasset.z".format(files))
+            write_archive(path, size, chunk_size, level, seed=files)
+            with open(path + ".uncompressed_size", "w") as f:
+                f.write(str(size))
+            files += 1
+            total += size
+    return files, total
+
+
+def mod_dodo(root, jobs, governor=None):
+    """
+    A ModDodo for the generated mod and server below root that always extracts everything, with a ResourceGovernor
+    made from the governor dict if given.
+    """
+    return moddodo.ModDodo(".", [os.path.join(root, "server")], os.path.join(root, "content"), extract_workers=jobs, full_extract=True,
+                           governor=moddodo.ResourceGovernor(**governor) if governor else None)
+
+
+UNPACKERS = {
+    "legacy": lambda src, dst: legacy_unpack(src, dst),
+    "streaming": lambda src, dst: arkit.unpack(src, dst),
+    "parallel": lambda src, dst: arkit.unpack(src, dst, workers=None),
+}
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process in KiB.
+    VmHWM is preferred because ru_maxrss also remembers the parent's peak from before exec.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_one(name, src, dst):
+    """
+    Runs a single unpack in this process and prints "seconds peak_rss_kib".
+    """
+    start = time.perf_counter()
+    UNPACKERS[name](src, dst)
+    elapsed = time.perf_counter() - start
+    print("{:.6f} {}".format(elapsed, peak_rss()))
+
+
+def run_stage(stage, root, modid, jobs, governor=None):
+    """
+    Runs one stage of the extraction path on a generated mod in this process and prints its measurements as JSON.
+    """
+    srcdir = os.path.join(root, "content", modid, "WindowsNoEditor")
+    workdir = tempfile.mkdtemp(dir=root)
+    latencies = []
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        start = time.perf_counter()
+        if stage == "unpack":
+            for curdir, subdirs, files in os.walk(srcdir):
+                for file in files:
+                    if file.endswith(".z"):
+                        file_start = time.perf_counter()
+                        arkit.unpack(os.path.join(curdir, file), os.path.join(workdir, file[:-2]))
+                        latencies.append(time.perf_counter() - file_start)
+        elif stage == "extract":
+            dodo = mod_dodo(root, jobs, governor)
+            dodo.governor.apply_priority()
+            if not dodo.extract_mod(modid, workdir):
+                raise RuntimeError("extract_mod failed")
+        elif stage == "install":
+            if not mod_dodo(root, jobs, governor).run([modid], no_download=True).success:
+                raise RuntimeError("install failed")
+        elapsed = time.perf_counter() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        shutil.rmtree(workdir)
+    latencies.sort()
+    print(json.dumps({
+        "seconds": elapsed,
+        "rss_kib": peak_rss(),
+        "p50": latencies[len(latencies) // 2] if latencies else None,
+        "p95": latencies[int(len(latencies) * 0.95)] if latencies else None,
+        "max": latencies[-1] if latencies else None,
+    }))
+
+
+def measure(name, src, dst, repeat):
+    best = None
+    for i in range(repeat):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "run-one", name, src, dst])
+        elapsed, rss = output.split()
+        result = (float(elapsed), int(rss))
+        if best is None or result[0] < best[0]:
+            best = result
+    return best
+
+
+def bench_unpack(args):
+    workdir = tempfile.mkdtemp(dir=args.workdir)
+    src = os.path.join(workdir, "bench.uasset.z")
+    dst = os.path.join(workdir, "bench.uasset")
+    size = args.size * 1024 * 1024
+    write_archive(src, size, args.chunk)
+    print("Archive: {} MiB unpacked, {} MiB packed, chunk size {}".format(args.size, os.path.getsize(src) // (1024 * 1024), args.chunk))
+    print("{:<12} {:>10} {:>12} {:>14}".format("unpacker", "seconds", "MiB/s", "peak RSS MiB"))
+    try:
+        for name in args.unpackers:
+            elapsed, rss = measure(name, src, dst, args.repeat)
+            print("{:<12} {:>10.3f} {:>12.1f} {:>14.1f}".format(name, elapsed, args.size / elapsed, rss / 1024))
+    finally:
+        for path in (src, dst):
+            if os.path.exists(path):
+                os.remove(path)
+        os.rmdir(workdir)
+
+
+def measure_stage(stage, root, modid, jobs, repeat):
+    best = None
+    for i in range(repeat):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "run-stage", stage, root, modid, str(jobs)])
+        result = json.loads(output)
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+    return best
+
+
+def bench_mod(args):
+    root = tempfile.mkdtemp(dir=args.workdir)
+    modid = "1000000000"
+    try:
+        files, total = generate_mod(root, modid, args.profile, args.scale, args.chunk, args.level)
+        print("Mod: profile {}, {} archives, {:.1f} MiB unpacked, chunk size {}, level {}".format(args.profile, files, total / (1024 * 1024), args.chunk, args.level))
+        print("{:<10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>14}".format("stage", "seconds", "MiB/s", "files/s", "p50 ms", "p95 ms", "peak RSS MiB"))
+        for stage in args.stages:
+            result = measure_stage(stage, root, modid, args.jobs, args.repeat)
+            latency = lambda value: "{:.2f}".format(value * 1000) if value is not None else "-"
+            print("{:<10} {:>10.3f} {:>10.1f} {:>10.1f} {:>10} {:>10} {:>14.1f}".format(
+                stage, result["seconds"], total / (1024 * 1024) / result["seconds"], files / result["seconds"],
+                latency(result["p50"]), latency(result["p95"]), result["rss_kib"] / 1024))
+    finally:
+        shutil.rmtree(root)
+
+
+def governor_presets(rate, load, sync):
+    """
+    ResourceGovernor settings compared by the governor benchmark, from no limits to all of them.
+    """
+    return OrderedDict([
+        ("unlimited", {}),
+        ("nice", {"nice": 19, "ionice": "idle"}),
+        ("sync", {"sync_bytes": sync * 1024 * 1024}),
+        ("rate", {"write_rate": rate * 1024 * 1024}),
+        ("load", {"target_load": load}),
+        ("all", {"nice": 19, "ionice": "idle", "sync_bytes": sync * 1024 * 1024, "write_rate": rate * 1024 * 1024, "target_load": load}),
+    ])
+
+
+def spin(iterations):
+    total = 0
+    for i in range(iterations):
+        total += i
+    return total
+
+
+def probe_ticks(running, tick, work, save):
+    """
+    Simulate a game server next to an install: every tick seconds, a fixed amount of CPU work that takes work seconds
+    on an idle host, and every 10th tick a save of 256 KiB that is fsynced, until running() is false.
+    :returns list of lag per tick in seconds, how much longer than on an idle host each tick took
+    """
+    #Calibrate with the fastest of several runs, the host is idle when this starts
+    iterations = 100000
+    fastest = None
+    for i in range(5):
+        start = time.perf_counter()
+        spin(iterations)
+        elapsed = time.perf_counter() - start
+        fastest = elapsed if fastest is None else min(fastest, elapsed)
+    iterations = max(int(iterations * work / fastest), 1)
+    data = os.urandom(256 * 1024)
+    lags = []
+    ticks = 0
+    next_tick = time.perf_counter()
+    while running():
+        start = time.perf_counter()
+        spin(iterations)
+        if ticks % 10 == 0:
+            with open(save, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        lags.append(max(time.perf_counter() - start - work, 0.0) + max(start - next_tick, 0.0))
+        ticks += 1
+        next_tick += tick
+        time.sleep(max(next_tick - time.perf_counter(), 0))
+    os.remove(save)
+    return lags
+
+
+def bench_governor(args):
+    root = tempfile.mkdtemp(dir=args.workdir)
+    modid = "1000000000"
+    save = os.path.join(root, "tick.sav")
+    try:
+        files, total = generate_mod(root, modid, args.profile, args.scale)
+        print("Mod: profile {}, {} archives, {:.1f} MiB unpacked, {} jobs".format(args.profile, files, total / (1024 * 1024), args.jobs))
+        print("Game tick: {:.0f} ms of work every {:.0f} ms, a 256 KiB fsynced save every 10 ticks".format(args.work * 1000, args.tick * 1000))
+        print("{:<10} {:>10} {:>10} {:>12} {:>12} {:>12}".format("governor", "seconds", "MiB/s", "lag p50 ms", "lag p99 ms", "lag max ms"))
+        deadline = time.perf_counter() + args.idle
+        lags = sorted(probe_ticks(lambda: time.perf_counter() < deadline, args.tick, args.work, save))
+        print("{:<10} {:>10} {:>10} {:>12.2f} {:>12.2f} {:>12.2f}".format("idle", "-", "-", lags[len(lags) // 2] * 1000, lags[int(len(lags) * 0.99)] * 1000, lags[-1] * 1000))
+        for name, governor in governor_presets(args.rate, args.load, args.sync).items():
+            if name not in args.presets:
+                continue
+            process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "run-stage", "extract", root, modid, str(args.jobs), "--governor", json.dumps(governor)],
+                                       stdout=subprocess.PIPE)
+            lags = sorted(probe_ticks(lambda: process.poll() is None, args.tick, args.work, save))
+            if process.returncode != 0:
+                raise RuntimeError("extract failed with governor " + name)
+            result = json.loads(process.stdout.read())
+            process.stdout.close()
+            print("{:<10} {:>10.3f} {:>10.1f} {:>12.2f} {:>12.2f} {:>12.2f}".format(
+                name, result["seconds"], total / (1024 * 1024) / result["seconds"],
+                lags[len(lags) // 2] * 1000, lags[int(len(lags) * 0.99)] * 1000, lags[-1] * 1000))
+    finally:
+        shutil.rmtree(root)
+
+
+def load_chunks(paths, limit):
+    """
+    Read the compressed chunks of the given .z files, or of every .z file below the given directories,
+    until limit compressed bytes are loaded.
+    :returns list of (compressed chunk, unpacked size)
+    """
+    archives = []
+    for path in paths:
+        if os.path.isdir(path):
+            for curdir, subdirs, files in os.walk(path):
+                archives.extend(os.path.join(curdir, file) for file in sorted(files) if file.endswith(".z"))
+        else:
+            archives.append(path)
+    chunks = []
+    loaded = 0
+    for archive in archives:
+        info = arkit.read_info(archive)
+        with open(archive, "rb") as f:
+            f.seek(info.data_offset)
+            for compressed, uncompressed in zip(info.compression_index[0::2], info.compression_index[1::2]):
+                if loaded >= limit:
+                    return chunks
+                chunks.append((f.read(compressed), uncompressed))
+                loaded += compressed
+    return chunks
+
+
+def bench_codecs(args):
+    workdir = None
+    paths = args.archives
+    if not paths:
+        workdir = tempfile.mkdtemp(dir=args.workdir)
+        paths = [os.path.join(workdir, "bench.uasset.z")]
+        write_archive(paths[0], args.size * 1024 * 1024, args.chunk)
+    try:
+        chunks = load_chunks(paths, args.limit * 1024 * 1024)
+    finally:
+        if workdir:
+            shutil.rmtree(workdir)
+    if not chunks:
+        print("No .z chunks found")
+        sys.exit(1)
+    packed = sum(len(data) for data, uncompressed in chunks)
+    unpacked = sum(uncompressed for data, uncompressed in chunks)
+    print("Chunks: {}, {:.1f} MiB packed, {:.1f} MiB unpacked".format(len(chunks), packed / (1024 * 1024), unpacked / (1024 * 1024)))
+    print("{:<10} {:>10} {:>12} {:>10}".format("codec", "seconds", "MiB/s", "vs zlib"))
+    results = []
+    for name in arkit.available_codecs():
+        codec = arkit.CODECS[name]
+        best = None
+        for i in range(args.repeat):
+            start = time.perf_counter()
+            for data, uncompressed in chunks:
+                codec.decompress(data, zlib.MAX_WBITS, uncompressed)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results.append((name, best))
+    baseline = dict(results)["zlib"]
+    for name, elapsed in results:
+        print("{:<10} {:>10.3f} {:>12.1f} {:>9.2f}x".format(name, elapsed, unpacked / (1024 * 1024) / elapsed, baseline / elapsed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the .z extraction path")
+    subparsers = parser.add_subparsers(dest="command")
+
+    unpack = subparsers.add_parser("unpack", help="compare arkit.unpack implementations on one synthetic archive")
+    unpack.add_argument("--size", type=int, default=256, help="unpacked archive size in MiB, default: 256")
+    unpack.add_argument("--chunk", type=int, default=131072, help="chunk size in bytes, default: 131072")
+    unpack.add_argument("--repeat", type=int, default=3, help="runs per implementation, the best is reported, default: 3")
+    unpack.add_argument("--workdir", default=None, help="directory for the synthetic archive, default: system temp dir")
+    unpack.add_argument("--unpackers", nargs="+", default=list(UNPACKERS), choices=list(UNPACKERS), help="implementations to compare")
+
+    mod = subparsers.add_parser("mod", help="measure unpack, extract_mod and a full install on a synthetic mod")
+    mod.add_argument("--profile", default="mixed", choices=list(PROFILES), help="synthetic mod layout: many tiny files, a mix or a few multi-GB archives, default: mixed")
+    mod.add_argument("--scale", type=float, default=1.0, help="multiply every file size of the profile, default: 1.0")
+    mod.add_argument("--chunk", type=int, default=arkit.DEFAULT_CHUNK_SIZE, help="chunk size in bytes, default: {}".format(arkit.DEFAULT_CHUNK_SIZE))
+    mod.add_argument("--level", type=int, default=6, help="zlib compression level, default: 6")
+    mod.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="files extracted concurrently by extract and install, default: all cores")
+    mod.add_argument("--repeat", type=int, default=3, help="runs per stage, the best is reported, default: 3")
+    mod.add_argument("--workdir", default=None, help="directory for the synthetic mod and server, default: system temp dir")
+    mod.add_argument("--stages", nargs="+", default=["unpack", "extract", "install"], choices=["unpack", "extract", "install"], help="stages to measure")
+
+    codecs = subparsers.add_parser("codecs", help="compare the installed decompression backends on the chunks of .z files")
+    codecs.add_argument("archives", nargs="*", help=".z files or directories with .z files, e.g. a downloaded mod, default: a synthetic archive")
+    codecs.add_argument("--limit", type=int, default=256, help="MiB of compressed chunks to load, default: 256")
+    codecs.add_argument("--size", type=int, default=64, help="unpacked size of the synthetic archive in MiB, default: 64")
+    codecs.add_argument("--chunk", type=int, default=arkit.DEFAULT_CHUNK_SIZE, help="chunk size of the synthetic archive in bytes, default: {}".format(arkit.DEFAULT_CHUNK_SIZE))
+    codecs.add_argument("--repeat", type=int, default=3, help="runs per codec, the best is reported, default: 3")
+    codecs.add_argument("--workdir", default=None, help="directory for the synthetic archive, default: system temp dir")
+
+    governor = subparsers.add_parser("governor", help="measure extraction throughput against the lag of a simulated game server for ResourceGovernor settings")
+    governor.add_argument("--profile", default="mixed", choices=list(PROFILES), help="synthetic mod layout, default: mixed")
+    governor.add_argument("--scale", type=float, default=1.0, help="multiply every file size of the profile, default: 1.0")
+    governor.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="files extracted concurrently, default: all cores")
+    governor.add_argument("--rate", type=float, default=100, help="MiB/s of the rate limited settings, default: 100")
+    governor.add_argument("--load", type=float, default=max((os.cpu_count() or 1) / 2, 1), help="target load average of the load adaptive settings, default: half the cores")
+    governor.add_argument("--sync", type=int, default=32, help="MiB between two syncs of the sync settings, default: 32")
+    governor.add_argument("--tick", type=float, default=0.05, help="seconds between two game ticks, default: 0.05")
+    governor.add_argument("--work", type=float, default=0.01, help="seconds of CPU work per game tick on an idle host, default: 0.01")
+    governor.add_argument("--idle", type=float, default=3, help="seconds the game ticks are measured without an install first, default: 3")
+    governor.add_argument("--workdir", default=None, help="directory for the synthetic mod and server, default: system temp dir")
+    governor.add_argument("--presets", nargs="+", default=list(governor_presets(0, 0, 0)), choices=list(governor_presets(0, 0, 0)), help="governor settings to measure")
+
+    stage = subparsers.add_parser("run-stage")
+    stage.add_argument("stage", choices=["unpack", "extract", "install"])
+    stage.add_argument("root")
+    stage.add_argument("modid")
+    stage.add_argument("jobs", type=int)
+    stage.add_argument("--governor", type=json.loads, default=None)
+
+    one = subparsers.add_parser("run-one")
+    one.add_argument("name", choices=list(UNPACKERS))
+    one.add_argument("src")
+    one.add_argument("dst")
+
+    args = parser.parse_args()
+
+    if args.command == "unpack":
+        bench_unpack(args)
+    elif args.command == "mod":
+        bench_mod(args)
+    elif args.command == "codecs":
+        bench_codecs(args)
+    elif args.command == "governor":
+        bench_governor(args)
+    elif args.command == "run-stage":
+        run_stage(args.stage, args.root, args.modid, args.jobs, args.governor)
+    elif args.command == "run-one":
+        run_one(args.name, args.src, args.dst)
+    else:
+        print(parser.format_help())
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,10 +4,29 @@ import arkit
 import sys
 import os
 import argparse
+import asyncio
+import concurrent.futures
+import contextlib
+import cProfile
+import ctypes
+import errno
+import fcntl
+import functools
+import hashlib
+import itertools
+import json
+import pstats
+import re
+import select
 import shutil
+import signal
 import subprocess
 import tempfile
-from collections import OrderedDict
+import threading
+import time
+import urllib.parse
+import urllib.request
+from collections import OrderedDict, namedtuple
 import struct
 
 SERVER_MOD_DIRECTORY = "ShooterGame/Content/Mods"
@@ -18,87 +37,687 @@ STEAMCMD_MODS_PATH = "~/.local/share/Steam/steamapps/workshop/content/346110"
 SERVER_CHECK_PATH = "ShooterGame/Content"
 STEAMCMD_SCRIPT = "steamcmd"
 
+STEAMCMD_SUCCESS = "success"
+STEAMCMD_FAILURE = "failure"
+STEAMCMD_SUCCESS_PATTERN = re.compile(r'Success\. Downloaded item (\d+) to "([^"]*)"')
+STEAMCMD_FAILURE_PATTERN = re.compile(r'ERROR! Download item (\d+) failed \(([^)]*)\)')
+STEAMCMD_TIMEOUT_PATTERN = re.compile(r'ERROR! Timeout downloading item (\d+)')
+
+WORKSHOP_APPID = "346110"
+WORKSHOP_MANIFEST = "appworkshop_" + WORKSHOP_APPID + ".acf"
+WORKSHOP_DETAILS_URL = "https://api.steampowered.com/ISteamRemoteStorage/GetPublishedFileDetails/v1/"
+WORKSHOP_DETAILS_TIMEOUT = 15
+ACF_TOKEN_PATTERN = re.compile(r'\s+|//[^\r\n]*|\[[^\]\r\n]*\]|"((?:[^"\\]|\\.)*)"|([{}])|([^\s"{}\[\]]+)|(.)', re.S)
+
 WINDOWS_NOEDITOR = "WindowsNoEditor"
 WINDOWS_NOEDITOR_MODFILE = WINDOWS_NOEDITOR + ".mod"
 WINDOWS_NOEDITOR_MOD_INFO = WINDOWS_NOEDITOR + "/mod.info"
 WINDOWS_NOEDITOR_MODMETA_INFO = WINDOWS_NOEDITOR + "/modmeta.info"
 
+MOD_MANIFEST_SUFFIX = ".moddodo.json"
+MOD_MANIFEST_VERSION = 1
+
+CATALOG_FILE = ".moddodo-catalog.json"
+CATALOG_VERSION = 1
+
+STORE_KEEP_VERSIONS = 2
+
+MOD_PENDING = "pending"
+MOD_INSTALLED = "installed"
+MOD_UP_TO_DATE = "up-to-date"
+MOD_VERIFIED = "verified"
+MOD_FAILED = "failed"
+
+# status is one of the MOD_ constants, servers the servers the mod was installed on, errors the messages of its problems
+ModResult = namedtuple("ModResult", ["modid", "status", "servers", "errors"])
+# success is false if any mod failed, mods maps every mod id of the run to its ModResult
+RunResult = namedtuple("RunResult", ["success", "mods"])
+
+FICLONE = 0x40049409
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+STAGING_DIRECTORY = ".moddodo-staging"
+STAGING_STALE_AGE = 24 * 60 * 60
+
+PATCH_MIN_SIZE = 16 * 1024 * 1024
+
+PLAN_RESERVE = 512 * 1024 * 1024
+PLAN_SAMPLE_BYTES = 64 * 1024 * 1024
+
+GOVERNOR_INTERVAL = 5
+GOVERNOR_BURST = 0.25
+GOVERNOR_COPY_SIZE = 8 * 1024 * 1024
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+# ioprio_set has no libc wrapper, so it is called by its syscall number
+SYS_IOPRIO_SET = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "armv7l": 314, "riscv64": 30}
+
+PARTIAL_SUFFIX = ".partial"
+JOURNAL_SUFFIX = ".moddodo-journal"
+
+WATCH_SETTLE = 15
+WATCH_POLL_INTERVAL = 60
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+                 | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
 
 class ModDodo:
-    def __init__(self, steamcmd_directory, modids, server_directory, local_mod_directory, mod_update, steamcmd_delete_cache, no_download, force_update):
+    """
+    Installs ARK mods on one or more servers. Constructing it only checks and remembers the setup, every run() or
+    watch() then works with it, so a long-lived process can keep one ModDodo per group of servers and run them
+    repeatedly or, with run_async(), concurrently. Problems with the setup raise ModDodoException, problems with
+    single mods end up in the ModResult of the mod.
+    """
+
+    def __init__(self, steamcmd_directory, server_directories, local_mod_directory=".", chunk_workers=1, extract_workers=None, mod_workers=1, move_workers=1, full_extract=False, store_directory=None, metrics_path=None, profile_path=None, governor=None, workshop_check=False, plan_reserve=PLAN_RESERVE):
         self.steamcmd_directory = steamcmd_directory
-        self.server_directory = server_directory
-
-        self.check_server_directory()
-        if not no_download:
-            self.check_steamcmd_directory()
-
-        if not modids:
-            modids = []
-        if mod_update:
-            self.append_installed_mods(modids)
-
-        print("Installing mods: " + ', '.join(modids))
-
-        # Mod/.z/UE magic stuff
-        self.map_names = []  # stores map names from mod.info
-        self.meta_data = OrderedDict([])  # stores key value from modmeta.info
-
-        if local_mod_directory is '.':
+        self.chunk_workers = chunk_workers
+        self.extract_workers = extract_workers or os.cpu_count() or 1
+        self.mod_workers = mod_workers
+        self.move_workers = move_workers
+        self.full_extract = full_extract
+        self.workshop_check = workshop_check
+        self.plan_reserve = plan_reserve
+        if isinstance(server_directories, str):
+            server_directories = [server_directories]
+        self.server_directories = server_directories
+        self.store_directory = store_directory
+        self.metrics_path = metrics_path
+        self.profile_path = profile_path
+        self.governor = governor or ResourceGovernor()
+        self.cleanup_lock = threading.Lock()
+        self.cleanup_threads = []
+        self.checked_staging = set()
+        self.metrics = Metrics()
+        self.progress = None
+        self.results_lock = threading.Lock()
+        self.results = OrderedDict()
+
+        for server_directory in self.server_directories:
+            self.check_server_directory(server_directory)
+        self.catalogs = OrderedDict((server_directory, ModCatalog(server_directory)) for server_directory in self.server_directories)
+
+        if local_mod_directory == '.':
           self.download_mod_directory = os.path.expanduser(STEAMCMD_MODS_PATH)
         else:
           self.download_mod_directory = os.path.normpath(local_mod_directory)
 
-        print("Mod directory: " + self.download_mod_directory)
+    def run(self, modids, mod_update=False, steamcmd_delete_cache=False, no_download=False, force_update=False, verify=False, deep_verify=False, progress=None, space_check=True):
+        """
+        Download and install (or with verify, only verify) the given mods on all servers, plus every installed mod
+        with mod_update. progress is called with (mod id, bytes) whenever bytes of a mod were decompressed, from the
+        worker threads. Unless space_check is false, the run is refused if it would leave less than plan_reserve bytes
+        free on a file system. Only one run per ModDodo may be active at a time.
+        :returns RunResult with a ModResult per mod
+        """
+        modids = list(modids or [])
+        self.progress = progress
+        self.results = OrderedDict()
+        self.metrics = Metrics(self.metrics_path, self.profile_path)
+        self.governor.apply_priority()
+        # Another process may have installed mods since the last run
+        self.catalogs = OrderedDict((server_directory, ModCatalog(server_directory)) for server_directory in self.server_directories)
+        try:
+            if not no_download and not verify:
+                self.check_steamcmd_directory()
+
+            if mod_update:
+                self.append_installed_mods(modids)
+            for modid in modids:
+                self.record(modid)
+
+            print("Installing mods: " + ', '.join(modids))
+            print("Mod directory: " + self.download_mod_directory)
+
+            if verify:
+                if not modids:
+                    modids.extend(self.downloaded_mods())
+                self.verify_mods(modids, deep_verify)
+                return self.run_result()
+
+            # Refuse to start what would fill a disk halfway through, judged by the versions downloaded so far
+            if space_check:
+                self.check_space([modid for modid in modids if os.path.isdir(os.path.join(self.download_mod_directory, modid, WINDOWS_NOEDITOR))
+                                  and (not mod_update or force_update or not self.up_to_date(modid))])
+
+            if not no_download:
+                if steamcmd_delete_cache:
+                    self.delete_steamcmd_cache()
+
+            # Without a download every mod is ready right away, otherwise each mod enters the pipeline as soon as SteamCMD reports it
+            self.download_failures = OrderedDict()
+            if no_download:
+                ready = modids
+            else:
+                outdated = modids if force_update else self.outdated_mods(modids)
+                current = [modid for modid in modids if modid not in outdated]
+                if current:
+                    print("Mods already up to date in " + self.download_mod_directory + ": " + ', '.join(current))
+                ready = itertools.chain(current, self.download_mods(outdated)) if outdated else current
+
+            self.install_mods(modid for modid in ready if self.needs_install(modid, mod_update, force_update))
+            self.wait_for_cleanup()
+
+            for modid, reason in self.download_failures.items():
+                self.record(modid, error="Could not download mod " + str(modid) + ": " + reason)
+            return self.run_result()
+        finally:
+            self.progress = None
+            self.metrics.close()
+
+    async def run_async(self, modids, progress=None, **options):
+        """
+        asyncio variant of run(): the run happens on the loop's default executor and progress is called on the event
+        loop instead of the worker threads. Runs of several ModDodo instances, e.g. one per server, can be awaited
+        together with asyncio.gather.
+        :returns RunResult with a ModResult per mod
+        """
+        loop = asyncio.get_running_loop()
+        if progress is not None:
+            callback = progress
+            progress = lambda modid, size: loop.call_soon_threadsafe(callback, modid, size)
+        return await loop.run_in_executor(None, functools.partial(self.run, modids, progress=progress, **options))
 
-        if not no_download:
-            if steamcmd_delete_cache:
-                self.delete_steamcmd_cache()
+    def record(self, modid, status=None, server=None, error=None):
+        """
+        Note the outcome of a mod for the RunResult: a new status, a server it was installed on or an error,
+        which is printed as well and fails the mod.
+        """
+        if error:
+            print_error(error)
+        with self.results_lock:
+            result = self.results.setdefault(modid, {"status": MOD_PENDING, "servers": [], "errors": []})
+            if server:
+                result["servers"].append(server)
+            if error:
+                result["errors"].append(error)
+                result["status"] = MOD_FAILED
+            elif status and result["status"] != MOD_FAILED:
+                result["status"] = status
+
+    def run_result(self):
+        with self.results_lock:
+            mods = OrderedDict((modid, ModResult(modid, result["status"], list(result["servers"]), list(result["errors"])))
+                               for modid, result in self.results.items())
+        return RunResult(all(mod.status != MOD_FAILED for mod in mods.values()), mods)
+
+    def watch(self, modids):
+        """
+        Keep running and install mods whenever they change in the local mod directory, until interrupted.
+        Changes are reported by a WorkshopWatcher; a mod is only looked at once nothing was written to it for
+        WATCH_SETTLE seconds, so a download SteamCMD is still writing is never picked up. Only the mods that
+        changed are compared with the catalogs, which stay in memory between changes. Every batch of changed mods gets
+        fresh results and metrics, like a run of its own, with the profile stats merged over all batches.
+        Without mod ids every mod in the directory is watched. SIGTERM stops watching like Ctrl+C.
+        """
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+        watched = set(modids)
+        profile_stats = None
+        self.governor.apply_priority()
+        watcher = WorkshopWatcher(self.download_mod_directory, lambda: modids or self.downloaded_mods(), self.mod_version)
+        print("Watching " + self.download_mod_directory + " for changed mods" + (" (polling)" if watcher.polling else ""))
+        # Mods already in the directory were not installed by the run before, when no ids were given
+        dirty = OrderedDict((modid, 0) for modid in ([] if modids else self.downloaded_mods()))
+        try:
+            while True:
+                now = time.monotonic()
+                settled = [modid for modid, changed in dirty.items() if now - changed >= WATCH_SETTLE]
+                if settled:
+                    for modid in settled:
+                        del dirty[modid]
+                    print("Changed mods: " + ', '.join(settled))
+                    self.results = OrderedDict()
+                    self.metrics = Metrics(self.metrics_path, self.profile_path)
+                    self.metrics.profile_stats = profile_stats
+                    try:
+                        self.install_mods(modid for modid in settled
+                                          if os.path.isdir(os.path.join(self.download_mod_directory, modid, WINDOWS_NOEDITOR))
+                                          and self.needs_install(modid, True, False))
+                        self.wait_for_cleanup()
+                    finally:
+                        profile_stats = self.metrics.profile_stats
+                        self.metrics.close()
+                    continue
+                timeout = WATCH_SETTLE - (now - min(dirty.values())) if dirty else None
+                for modid in watcher.wait(timeout):
+                    if not watched or modid in watched:
+                        dirty.pop(modid, None)
+                        dirty[modid] = time.monotonic()
+        except KeyboardInterrupt:
+            print("Stopped watching " + self.download_mod_directory)
+        finally:
+            watcher.close()
+
+    def needs_install(self, modid, mod_update, force_update):
+        """
+        Decide whether a downloaded mod has to be installed. Without --updatemods or with --force it always is,
+        otherwise only if a server's catalog does not list the downloaded version of the mod.
+        """
+        if not mod_update or force_update or not self.up_to_date(modid):
+            return True
+        print("Mod " + str(modid) + " is up to date")
+        self.record(modid, MOD_UP_TO_DATE)
+        return False
 
-        if not no_download:
-            if not self.download_mods(modids):
-                print_error("Could not download mods")
-                sys.exit(1)
+    def up_to_date(self, modid):
+        """
+        :returns true, if the catalog of every server lists the downloaded version of the mod and the mod directory
+        and .mod file are still on the server
+        """
+        version = self.mod_version(modid)
+        for server_directory, catalog in self.catalogs.items():
+            entry = catalog.get(modid)
+            if not entry or entry.get("version") != version:
+                return False
+            ark_mod_directory = os.path.join(server_directory, SERVER_MOD_DIRECTORY)
+            if not os.path.isdir(os.path.join(ark_mod_directory, modid)) or not os.path.isfile(os.path.join(ark_mod_directory, modid + ".mod")):
+                return False
+        return True
 
-        # SteamCMD does not properly break lines
-        print("")
+    def plan(self, modids, mod_update=False, force_update=False):
+        """
+        Dry run: work out what installing the mods (plus every installed mod with mod_update, minus the ones that are
+        up to date unless force_update) would take, see plan_mods. Nothing is downloaded or written.
+        :returns the plan as a dict that can be dumped as JSON
+        """
+        modids = list(modids or [])
+        self.catalogs = OrderedDict((server_directory, ModCatalog(server_directory)) for server_directory in self.server_directories)
+        if mod_update:
+            self.append_installed_mods(modids)
+        return self.plan_mods([modid for modid in modids if not mod_update or force_update or not self.up_to_date(modid)])
 
+    def check_space(self, modids):
+        """
+        Raise ModDodoException if installing the downloaded mods would leave less than plan_reserve bytes free on a
+        file system, see plan_mods.
+        """
+        plan = self.plan_mods(modids, measure=False)
+        full = [filesystem for filesystem in plan["filesystems"] if not filesystem["fits"]]
+        if full:
+            raise ModDodoException("Not enough disk space for the installation (use --nospacecheck or a smaller --reserve to install anyway):\n" + "\n".join(
+                "{}: {} MiB needed, {} MiB free".format(filesystem["path"], (filesystem["required_bytes"] + self.plan_reserve) // (1024 * 1024),
+                                                        filesystem["free_bytes"] // (1024 * 1024)) for filesystem in full))
+
+    def plan_mods(self, modids, measure=True):
+        """
+        Plan the installation of the downloaded mods from the headers of their .z files and the .uncompressed_size
+        files only: the bytes to unpack per mod, what unchanged files or the store save, and the space the run needs
+        at its peak on every file system, when the new versions are written while the old ones are still there,
+        compared with the free space there minus plan_reserve. With measure, the decompression throughput is measured
+        on up to PLAN_SAMPLE_BYTES of the archives to estimate how long unpacking takes with the configured workers.
+        Mods that are not downloaded or whose files do not check out are listed with their errors.
+        :returns the plan as a dict that can be dumped as JSON, "fits" is false if the run would run out of space
+        """
+        target = self.store_directory or self.server_directories[0]
+        link = bool(self.store_directory) or len(self.server_directories) > 1
+        filesystems = OrderedDict()
+
+        def require(path, size):
+            path = existing_parent(path)
+            filesystem = filesystems.setdefault(os.stat(path).st_dev, OrderedDict([("path", path), ("required_bytes", 0)]))
+            filesystem["required_bytes"] += size
+
+        require(target, 0)
+        mods = []
+        archives = []
         for modid in modids:
-            if os.path.isfile(os.path.join(self.download_mod_directory, modid, WINDOWS_NOEDITOR, "mod.info")):
-                steammodftime=os.path.getmtime(os.path.join(self.download_mod_directory, modid, WINDOWS_NOEDITOR, "mod.info"))
-            else:
-                steammodftime=1
-            if os.path.isfile(os.path.join(self.server_directory, SERVER_MOD_DIRECTORY, modid, "mod.info")):
-                arkmodftime=os.path.getmtime(os.path.join(self.server_directory, SERVER_MOD_DIRECTORY, modid, "mod.info"))
-            else:
-                arkmmodftime=0
-            if mod_update and steammodftime <= arkmodftime and force_update:
-                continue
-            self.workdir = tempfile.mkdtemp()
-            if self.extract_mod(modid):
-                if self.create_mod_file(modid):
-                    if self.move_mod(modid):
-                        print("Mod " + str(modid) + " successfully installed")
-                    else:
-                        print_error("Could not move mod " + str(modid))
+            mod, mod_archives = self.plan_mod(modid)
+            mods.append(mod)
+            archives.extend(mod_archives)
+            require(target, mod["unpack_bytes"])
+            mod["disk_bytes"] = mod["unpack_bytes"]
+            for server_directory in self.server_directories:
+                # Linked into servers on the same file system as the extraction, copied into the others
+                if link and os.stat(existing_parent(server_directory)).st_dev != os.stat(existing_parent(target)).st_dev:
+                    require(server_directory, mod["unpacked_bytes"])
+                    mod["disk_bytes"] += mod["unpacked_bytes"]
+
+        for filesystem in filesystems.values():
+            st = os.statvfs(filesystem["path"])
+            filesystem["free_bytes"] = st.f_bavail * st.f_frsize
+            filesystem["fits"] = filesystem["required_bytes"] + self.plan_reserve <= filesystem["free_bytes"]
+
+        plan = OrderedDict()
+        plan["mods"] = mods
+        plan["unpack_bytes"] = sum(mod["unpack_bytes"] for mod in mods)
+        plan["filesystems"] = list(filesystems.values())
+        plan["reserve_bytes"] = self.plan_reserve
+        if measure:
+            plan.update(self.estimate_time(archives))
+        plan["fits"] = all(filesystem["fits"] for filesystem in filesystems.values())
+        return plan
+
+    def plan_mod(self, modid):
+        """
+        :returns (plan of one mod, list of (unpacked size, path, plan of the mod) of the .z files that would be unpacked)
+        """
+        srcdir = os.path.join(self.download_mod_directory, modid, WINDOWS_NOEDITOR)
+        mod = OrderedDict([("mod", modid), ("version", None), ("files", 0), ("chunks", 0), ("packed_bytes", 0),
+                           ("unpacked_bytes", 0), ("unpack_bytes", 0), ("reused_bytes", 0), ("stored", False), ("errors", [])])
+        if not os.path.isdir(srcdir):
+            mod["errors"].append("Mod directory does not exist in local mod repository")
+            return mod, []
+        mod["version"] = self.mod_version(modid)
+        mod["stored"] = bool(self.store_directory) and os.path.isdir(os.path.join(self.store_directory, modid, mod["version"]))
+        installdir, manifest_path = self.previous_install(modid)
+        previous = {} if self.full_extract or not manifest_path else self.load_manifest(manifest_path)
+        archives = []
+        for curdir, subdirs, files in os.walk(srcdir):
+            for file in files:
+                src = os.path.join(curdir, file)
+                name, ext = os.path.splitext(file)
+                if ext == ".info":
+                    size = os.path.getsize(src)
+                elif ext == ".z":
+                    try:
+                        info = arkit.read_info(src)
+                        with open(src + ".uncompressed_size", "r") as fd:
+                            unpacked_size = int(fd.read())
+                    except (arkit.UnpackException, OSError, ValueError) as e:
+                        mod["errors"].append(os.path.relpath(src, srcdir) + ": " + str(e))
+                        continue
+                    if info.size_unpacked != unpacked_size:
+                        mod["errors"].append(os.path.relpath(src, srcdir) + ": unpacks to " + str(info.size_unpacked) + " bytes, but .uncompressed_size says " + str(unpacked_size))
+                    size = info.size_unpacked
+                    mod["chunks"] += len(info.compression_index) // 2
+                    mod["packed_bytes"] += os.path.getsize(src)
+                else:
+                    continue
+                mod["files"] += 1
+                mod["unpacked_bytes"] += size
+                if mod["stored"]:
+                    continue
+                relpath = os.path.relpath(src, srcdir)
+                entry = previous.get(relpath)
+                st = os.stat(src)
+                installed = os.path.join(installdir, os.path.splitext(relpath)[0]) if installdir else None
+                # The same check as unchanged_hash, without hashing sources whose mtime changed
+                if ext == ".z" and entry and entry.get("size") == st.st_size and entry.get("mtime_ns") == st.st_mtime_ns \
+                        and installed and os.path.isfile(installed) and os.path.getsize(installed) == entry.get("output_size"):
+                    mod["reused_bytes"] += size
                 else:
-                    print_error("Could not create .mod file for mod " + str(modid))
+                    mod["unpack_bytes"] += size
+                    if ext == ".z":
+                        archives.append((size, src, mod))
+        return mod, archives
+
+    def estimate_time(self, archives):
+        """
+        Measure the single thread decompression throughput on up to PLAN_SAMPLE_BYTES of the biggest archives and
+        estimate the time to unpack all of them with the configured workers. The biggest archive alone is a lower
+        bound, its chunks only spread over chunk_workers, and so is the write rate of the governor. Archives that
+        cannot be decompressed are left out of the sample and their error is added to the plan of their mod.
+        """
+        archives = sorted(archives, key=lambda archive: archive[:2], reverse=True)
+        total = sum(size for size, src, mod in archives)
+        chunk_workers = self.chunk_workers or os.cpu_count() or 1
+        threads = max(min(self.extract_workers * chunk_workers, os.cpu_count() or 1), 1)
+        if not total:
+            return OrderedDict([("unpack_mib_per_second", None), ("threads", threads), ("estimated_seconds", 0.0)])
+        sampled = 0
+        start = time.perf_counter()
+        for size, src, mod in archives:
+            try:
+                for data in arkit.iter_unpack(src):
+                    sampled += len(data)
+                    if sampled >= PLAN_SAMPLE_BYTES:
+                        break
+            except (arkit.UnpackException, OSError) as e:
+                mod["errors"].append(os.path.relpath(src, os.path.join(self.download_mod_directory, mod["mod"], WINDOWS_NOEDITOR)) + ": " + str(e))
+            if sampled >= PLAN_SAMPLE_BYTES:
+                break
+        if not sampled:
+            return OrderedDict([("unpack_mib_per_second", None), ("threads", threads), ("estimated_seconds", None)])
+        rate = sampled / max(time.perf_counter() - start, 1e-9)
+        seconds = max(total / (rate * threads), archives[0][0] / (rate * min(chunk_workers, threads)))
+        if self.governor.write_rate:
+            seconds = max(seconds, total / self.governor.write_rate)
+        return OrderedDict([("unpack_mib_per_second", round(rate / (1024 * 1024), 1)), ("threads", threads), ("estimated_seconds", round(seconds, 1))])
+
+    def install_mods(self, modids):
+        """
+        Install mods as a pipeline: up to self.mod_workers mods are extracted and get their .mod file at the same time,
+        while finished mods are moved to the server by self.move_workers threads. Every mod has its own workdir,
+        so nothing is shared between mods in flight. modids may be any iterable, e.g. a generator yielding mods
+        while they are still being downloaded; each mod starts as soon as it is yielded.
+        :returns list of mod ids that were installed successfully
+        """
+        installed = []
+        moved = {}
+        lock = threading.Lock()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.mod_workers) as prepare_pool, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.move_workers) as move_pool:
+
+            def prepare(modid):
+                try:
+                    workdir = self.prepare_mod(modid)
+                except Exception as e:
+                    self.record(modid, error="Could not install mod " + str(modid) + ":\n" + str(e))
+                    return
+                if workdir:
+                    with lock:
+                        moved[move_pool.submit(finish, modid, workdir)] = modid
+
+            def finish(modid, workdir):
+                try:
+                    return self.finish_mod(modid, workdir)
+                except Exception as e:
+                    self.record(modid, error="Could not install mod " + str(modid) + ":\n" + str(e))
+                    return False
+
+            preparing = [prepare_pool.submit(prepare, modid) for modid in modids]
+            concurrent.futures.wait(preparing)
+
+            for future in concurrent.futures.as_completed(moved):
+                if future.result():
+                    installed.append(moved[future])
+        return installed
+
+    def prepare_mod(self, modid):
+        """
+        First pipeline stage: extract the mod and write its .mod file into a workdir.
+        With a shared store the result is kept in the store under the mod's version, and an existing store entry
+        for that version is used as is, so every mod version is only extracted once for all servers.
+        The workdir is named after the mod version and kept if the mod fails or the run is interrupted, so the next
+        attempt at the same version resumes from its journal instead of starting over.
+        :returns the workdir, or None if the mod failed
+        """
+        version = self.mod_version(modid)
+        if self.store_directory:
+            entry = os.path.join(self.store_directory, modid, version)
+            if os.path.isdir(entry):
+                print("- Using stored extraction of mod " + str(modid) + " (" + version + ")")
+                return entry
+            parent = os.path.join(self.store_directory, modid)
+            prefix = "."
+        else:
+            parent = self.staging_directory(self.server_directories[0])
+            prefix = str(modid) + "-"
+        os.makedirs(parent, 0o770, True)
+        workdir, lock = self.resumable_workdir(parent, prefix, version)
+
+        try:
+            with self.metrics.phase(modid, "extract"):
+                extracted = self.extract_mod(modid, workdir)
+            if extracted:
+                with self.metrics.phase(modid, "modfile"):
+                    created = self.create_mod_file(modid, workdir)
+                if created:
+                    item = (read_workshop_manifest(self.workshop_manifest_path()) or {}).get(modid)
+                    self.update_manifest(os.path.join(workdir, modid + MOD_MANIFEST_SUFFIX), mod_version=version,
+                                         workshop_manifest=item["manifest"] if item else None)
+                    os.remove(os.path.join(workdir, modid + JOURNAL_SUFFIX))
+                    if self.store_directory:
+                        return self.publish_stored_mod(modid, workdir, entry)
+                    # Give the finished mod a private name, the resumable one may be picked up by the next attempt
+                    private = tempfile.mkdtemp(dir=parent)
+                    os.rename(workdir, private)
+                    return private
+                else:
+                    self.record(modid, error="Could not create .mod file for mod " + str(modid))
             else:
-                print_error("Could not extract mod " + str(modid))
-            shutil.rmtree(self.workdir)
+                self.record(modid, error="Could not extract mod " + str(modid))
+        except BaseException:
+            if lock is None:
+                shutil.rmtree(workdir)
+            raise
+        finally:
+            if lock is not None:
+                os.close(lock)
+        if lock is None:
+            shutil.rmtree(workdir)
+        return None
+
+    def resumable_workdir(self, parent, prefix, version):
+        """
+        Workdir parent/<prefix><version>.partial for extracting a mod version, locked with flock so that only one
+        process works in it. Workdirs left by attempts at other versions of the mod are removed.
+        If another process is extracting the same version right now, a fresh temporary workdir is used instead.
+        :returns (workdir, fd holding the lock, or None for a temporary workdir)
+        """
+        name = prefix + version + PARTIAL_SUFFIX
+        for other in os.listdir(parent):
+            if other.startswith(prefix) and other.endswith(PARTIAL_SUFFIX) and other != name:
+                self.discard_partial(os.path.join(parent, other))
+        path = os.path.join(parent, name)
+        os.makedirs(path, 0o770, True)
+        path, lock = self.lock_directory(path)
+        if lock is None:
+            return tempfile.mkdtemp(prefix=".tmp-", dir=parent), None
+        return path, lock
+
+    def discard_partial(self, path):
+        """
+        Remove a resumable workdir in the background, unless a process is working in it.
+        """
+        path, lock = self.lock_directory(path)
+        if lock is not None:
+            trash = tempfile.mkdtemp(prefix=".trash-", dir=os.path.dirname(path))
+            os.rename(path, os.path.join(trash, os.path.basename(path)))
+            os.close(lock)
+            self.defer_cleanup(trash)
+
+    def lock_directory(self, path):
+        """
+        Take an exclusive flock on a directory without waiting.
+        :returns (path, fd), fd is None if the directory is locked elsewhere, gone or was replaced meanwhile
+        """
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        except OSError:
+            return path, None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # The holder before might have renamed it away, e.g. to publish it in the store
+            if os.path.samestat(os.fstat(fd), os.stat(path)):
+                return path, fd
+        except OSError:
+            pass
+        os.close(fd)
+        return path, None
+
+    def finish_mod(self, modid, workdir):
+        """
+        Second pipeline stage: install the prepared mod on every server and clean up its workdir.
+        A single server without a store gets the workdir moved over, otherwise every server gets hardlinks.
+        """
+        link = bool(self.store_directory) or len(self.server_directories) > 1
+        manifest = self.read_manifest(os.path.join(workdir, modid + MOD_MANIFEST_SUFFIX))
+        try:
+            success = True
+            for server_directory in self.server_directories:
+                with self.metrics.phase(modid, "move"):
+                    moved = self.move_mod(modid, workdir, server_directory, link)
+                if moved:
+                    self.catalogs[server_directory].record(modid, catalog_entry(manifest))
+                    self.record(modid, MOD_INSTALLED, server_directory)
+                    print("Mod " + str(modid) + " successfully installed on " + server_directory)
+                else:
+                    self.record(modid, error="Could not move mod " + str(modid) + " to " + server_directory)
+                    success = False
+            return success
+        finally:
+            if not self.store_directory:
+                shutil.rmtree(workdir)
+
+    def mod_version(self, modid):
+        """
+        Version key of a downloaded mod for the shared store: a hash over path, size and mtime of all its files.
+        """
+        srcdir = os.path.join(self.download_mod_directory, modid, WINDOWS_NOEDITOR)
+        digest = hashlib.blake2b(digest_size=8)
+        for curdir, subdirs, files in os.walk(srcdir):
+            subdirs.sort()
+            for file in sorted(files):
+                st = os.stat(os.path.join(curdir, file))
+                digest.update("{}\0{}\0{}\n".format(os.path.relpath(os.path.join(curdir, file), srcdir), st.st_size, st.st_mtime_ns).encode())
+        return digest.hexdigest()
+
+    def stored_versions(self, modid):
+        """
+        :returns complete store entries of a mod, newest first
+        """
+        moddir = os.path.join(self.store_directory, modid)
+        if not os.path.isdir(moddir):
+            return []
+        entries = [os.path.join(moddir, name) for name in os.listdir(moddir) if not name.startswith(".")]
+        return sorted(entries, key=os.path.getmtime, reverse=True)
 
-    def check_server_directory(self):
-        if not os.path.isdir(os.path.join(self.server_directory, SERVER_CHECK_PATH)):
-            print_error("Given server directory " + self.server_directory + " does not contain '" + SERVER_CHECK_PATH + "'")
-            sys.exit(1)
+    def publish_stored_mod(self, modid, workdir, entry):
+        """
+        Atomically turn a finished workdir into the store entry. If another process published the same version
+        first, its entry wins. Only the two newest versions are kept, so a concurrent install of the previous
+        version can still link from it.
+        """
+        try:
+            os.rename(workdir, entry)
+        except OSError:
+            shutil.rmtree(workdir)
+        for old in self.stored_versions(modid)[STORE_KEEP_VERSIONS:]:
+            shutil.rmtree(old, ignore_errors=True)
+        return entry
+
+    def previous_install(self, modid):
+        """
+        Where the last extraction of a mod can be found for reusing unchanged files: the newest store entry,
+        or the installed mod of the first server.
+        :returns (mod directory, manifest path), or (None, None)
+        """
+        if self.store_directory:
+            for entry in self.stored_versions(modid):
+                return os.path.join(entry, modid), os.path.join(entry, modid + MOD_MANIFEST_SUFFIX)
+            return None, None
+        ark_mod_directory = os.path.join(self.server_directories[0], SERVER_MOD_DIRECTORY)
+        return os.path.join(ark_mod_directory, modid), os.path.join(ark_mod_directory, modid + MOD_MANIFEST_SUFFIX)
+
+    def check_server_directory(self, server_directory):
+        if not os.path.isdir(os.path.join(server_directory, SERVER_CHECK_PATH)):
+            raise ModDodoException("Given server directory " + server_directory + " does not contain '" + SERVER_CHECK_PATH + "'")
         else:
-            print("Installing mods for server: " + self.server_directory)
+            print("Installing mods for server: " + server_directory)
 
     def check_steamcmd_directory(self):
         if not os.path.isfile(os.path.join(self.steamcmd_directory, STEAMCMD_SCRIPT)):
-            print_error("Given SteamCMD directory " + self.steamcmd_directory + " does not contain '" + STEAMCMD_SCRIPT + "'\n"
-                        + "\tSee https://developer.valvesoftware.com/wiki/SteamCMD#Linux on how to install")
-            sys.exit(1)
+            raise ModDodoException("Given SteamCMD directory " + self.steamcmd_directory + " does not contain '" + STEAMCMD_SCRIPT + "'\n"
+                                   + "\tSee https://developer.valvesoftware.com/wiki/SteamCMD#Linux on how to install")
         else:
             print("Using SteamCMD: " + self.steamcmd_directory)
 
@@ -123,42 +742,243 @@ class ModDodo:
     def append_installed_mods(self, modids):
         print("Gurr. Reading installed mods...")
 
-        if not os.path.isdir(os.path.join(self.server_directory, SERVER_MOD_DIRECTORY)):
-            print_error("Given server directory " + self.server_directory + " does not contain " + SERVER_MOD_DIRECTORY + ".\n"
-                        + "Cannot find any mods to update.")
-            return
-        for current_dir, directories, files in os.walk(os.path.join(self.server_directory, SERVER_MOD_DIRECTORY)):
-            for directory in directories:
+        for server_directory in self.server_directories:
+            catalog = self.catalogs[server_directory]
+            # Mods deleted from the server by hand are forgotten instead of being installed again
+            removed = [modid for modid in catalog.mods if not os.path.isdir(os.path.join(server_directory, SERVER_MOD_DIRECTORY, modid))]
+            if removed:
+                print("Mods no longer installed on " + server_directory + ": " + ', '.join(removed))
+                catalog.remove(removed)
+            modids.extend(modid for modid in catalog.mods if modid not in modids)
+            # Mods installed before the catalog existed or by other tools are only found in the mod directory,
+            # they get cataloged when they are installed
+            if not os.path.isdir(os.path.join(server_directory, SERVER_MOD_DIRECTORY)):
+                if not catalog.exists:
+                    print_error("Given server directory " + server_directory + " does not contain " + SERVER_MOD_DIRECTORY + ".\n"
+                                + "Cannot find any mods to update.")
+                continue
+            for directory in sorted(os.listdir(os.path.join(server_directory, SERVER_MOD_DIRECTORY))):
                 # AFAIK these are updated by Ark itself, maybe only with -automanagedmods, 834585900 and 916417001 are maps
-                if directory.isdigit() and directory not in ["111111111", "834585900", "916417001"]:
+                if directory.isdigit() and directory not in ["111111111", "834585900", "916417001"] and directory not in modids \
+                        and os.path.isdir(os.path.join(server_directory, SERVER_MOD_DIRECTORY, directory)):
                     modids.append(directory)
-            break
+
+    def downloaded_mods(self):
+        """
+        :returns ids of all mods in the local mod directory
+        """
+        if not os.path.isdir(self.download_mod_directory):
+            return []
+        return sorted(name for name in os.listdir(self.download_mod_directory)
+                      if name.isdigit() and os.path.isdir(os.path.join(self.download_mod_directory, name, WINDOWS_NOEDITOR)))
+
+    def verify_mods(self, modids, deep=False):
+        """
+        Check downloaded mods against their .uncompressed_size files and the installed files of every server,
+        without extracting anything. Only the header and index of every .z file are read; with deep every archive
+        is also decompressed in memory, chunk by chunk, and its hash compared with the installed file.
+        :returns false, if any mod has a problem
+        """
+        success = True
+        for modid in modids:
+            print("- Verifying mod " + str(modid) + "...")
+            with self.metrics.phase(modid, "verify"):
+                problems = self.verify_mod(modid, deep)
+            if problems:
+                success = False
+                self.record(modid, error="Mod " + str(modid) + " failed verification:\n" + "\n".join("   * " + problem for problem in problems))
+            else:
+                self.record(modid, MOD_VERIFIED)
+                print("Mod " + str(modid) + " verified")
+        return success
+
+    def verify_mod(self, modid, deep):
+        """
+        :returns list of problems found for one mod, empty if it is fine
+        """
+        srcdir = os.path.join(self.download_mod_directory, modid, WINDOWS_NOEDITOR)
+        if not os.path.isdir(srcdir):
+            return ["Mod directory does not exist in local mod repository"]
+
+        archives = []
+        for curdir, subdirs, files in os.walk(srcdir):
+            for file in files:
+                if file.endswith(".z"):
+                    archives.append((os.path.join(curdir, file), os.path.relpath(os.path.join(curdir, file), srcdir)))
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.extract_workers) as executor:
+            results = executor.map(lambda archive: self.verify_file(modid, archive[0], archive[1], deep), archives)
+            return [problem for problems in results for problem in problems]
+
+    def verify_file(self, modid, src, relpath, deep):
+        """
+        Files that cannot be read, e.g. because they vanished or are not readable, are problems of that file only.
+        :returns list of problems found for one .z file
+        """
+        try:
+            info = arkit.read_info(src)
+        except (arkit.UnpackException, OSError) as e:
+            return [relpath + ": " + str(e)]
+
+        problems = []
+        try:
+            with open(src + ".uncompressed_size", "r") as fd:
+                unpacked_size = int(fd.read())
+            if unpacked_size != info.size_unpacked:
+                problems.append(relpath + ": archive declares " + str(info.size_unpacked) + " bytes but .uncompressed_size says " + str(unpacked_size))
+        except (OSError, ValueError) as e:
+            problems.append(relpath + ": could not read .uncompressed_size: " + str(e))
+
+        output = os.path.splitext(relpath)[0]
+        content_hash = None
+        for server_directory in self.server_directories:
+            installed = os.path.join(server_directory, SERVER_MOD_DIRECTORY, modid, output)
+            if not os.path.isfile(installed):
+                problems.append(output + ": not installed on " + server_directory)
+                continue
+            try:
+                size = os.path.getsize(installed)
+                if size != info.size_unpacked:
+                    problems.append(output + ": installed on " + server_directory + " with " + str(size) + " bytes instead of " + str(info.size_unpacked))
+                    continue
+            except OSError as e:
+                problems.append(output + ": could not read it on " + server_directory + ": " + str(e))
+                continue
+            if not deep:
+                continue
+            if content_hash is None:
+                try:
+                    digest = hashlib.blake2b(digest_size=16)
+                    for chunk in arkit.iter_unpack(src, self.chunk_workers):
+                        digest.update(chunk)
+                    content_hash = digest.hexdigest()
+                except (arkit.UnpackException, OSError) as e:
+                    problems.append(relpath + ": " + str(e))
+                    break
+            try:
+                if file_hash(installed) != content_hash:
+                    problems.append(output + ": installed on " + server_directory + " with different content")
+            except OSError as e:
+                problems.append(output + ": could not read it on " + server_directory + ": " + str(e))
+        return problems
+
+    def workshop_manifest_path(self):
+        """
+        SteamCMD keeps appworkshop_346110.acf in steamapps/workshop, two levels above the mod directory.
+        """
+        return os.path.normpath(os.path.join(self.download_mod_directory, os.pardir, os.pardir, WORKSHOP_MANIFEST))
+
+    def outdated_mods(self, modids):
+        """
+        Find the mods SteamCMD has to download, so a run without any new mod version does not start SteamCMD at all.
+        Mods missing from its workshop manifest or the mod directory, or flagged there as needing an update, are
+        always downloaded; if the manifest is unreadable, all of them are.
+        Of the others, only the ones whose manifest id in the workshop manifest is the one every server's catalog
+        recorded at install time are downloaded: for the rest a newer version is already there and only needs to be
+        installed. With workshop_check, the Steam Web API is asked instead when each mod was last updated, which
+        also finds new versions SteamCMD does not know of yet; if Steam cannot be asked, the catalogs decide.
+        :returns list of mod ids to download
+        """
+        items = read_workshop_manifest(self.workshop_manifest_path())
+        if items is None:
+            return list(modids)
+        outdated = [modid for modid in modids if modid not in items or items[modid]["needs_update"]
+                    or not os.path.isdir(os.path.join(self.download_mod_directory, modid, WINDOWS_NOEDITOR))]
+        known = [modid for modid in modids if modid not in outdated]
+        if not known:
+            return outdated
+        if self.workshop_check:
+            try:
+                updated = workshop_time_updated(known)
+                # Mods Steam does not report (removed or hidden) are left to SteamCMD to report
+                return [modid for modid in modids if modid in outdated or modid not in updated or updated[modid] > items[modid]["timeupdated"]]
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                print_error("Could not check the workshop for updated mods, comparing with the installed ones:\n" + str(e))
+        return [modid for modid in modids if modid in outdated or not self.downloaded_newer(modid, items[modid]["manifest"])]
+
+    def downloaded_newer(self, modid, manifest):
+        """
+        :returns true, if every server's catalog records the mod as installed from another workshop manifest id
+        """
+        for catalog in self.catalogs.values():
+            entry = catalog.get(modid)
+            if not entry or not entry.get("workshop_manifest") or entry["workshop_manifest"] == manifest:
+                return False
+        return True
 
     def download_mods(self, modids):
+        """
+        Download the mods with one SteamCMD run and follow its output while it runs.
+        This is a generator: every mod is yielded as soon as SteamCMD reports it as downloaded, so it can be
+        extracted while the others are still downloading. Mods that failed or were never reported end up in
+        self.download_failures with the reason.
+        """
         args = [os.path.join(self.steamcmd_directory, STEAMCMD_SCRIPT), "+login anonymous"]
         for modid in modids:
             args.extend(["+workshop_download_item", "346110", modid])
         args.append("+quit")
         try:
-            return subprocess.call(args) == 0
+            process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=0)
         except Exception as e:
-            print_error("Could not start steamcmd to download mods:\n" + str(e))
-            sys.exit(1)
+            raise ModDodoException("Could not start steamcmd to download mods:\n" + str(e))
+
+        pending = list(modids)
+        start = time.perf_counter()
+        with process:
+            buffer = b""
+            while True:
+                block = process.stdout.read(4096)
+                if block:
+                    sys.stdout.write(block.decode(errors="replace"))
+                    sys.stdout.flush()
+                    buffer += block
+                # SteamCMD does not properly break lines, progress is written with \r
+                lines = re.split(b"[\r\n]", buffer)
+                buffer = lines.pop() if block else b""
+                for line in lines:
+                    event = parse_steamcmd_line(line.decode(errors="replace"))
+                    if event and event[1] in pending:
+                        pending.remove(event[1])
+                        self.metrics.add(event[1], "download", time.perf_counter() - start, write=True)
+                        if event[0] == STEAMCMD_SUCCESS:
+                            yield event[1]
+                        else:
+                            self.download_failures[event[1]] = event[2]
+                if not block:
+                    break
+            returncode = process.wait()
+
+        # SteamCMD does not properly break lines
+        print("")
 
-    def extract_mod(self, modid):
+        for modid in pending:
+            self.download_failures[modid] = "SteamCMD exited with code " + str(returncode) + " without reporting the download"
+
+    def extract_mod(self, modid, workdir):
         """
         Extract the .z files using the arkit lib.
+        The .z files are unpacked concurrently on a pool of self.extract_workers threads, biggest first so that a huge
+        archive does not end up as a long single-threaded tail. The first failure cancels all files that have not started yet.
+        Files that did not change since the last install according to the mod's manifest are carried over from the
+        installed mod instead of being unpacked again; the new manifest is written to the workdir for move_mod.
         :returns false, if any file fails to download
         """
         print("- Extracting mod " + str(modid) + "...")
 
         if not os.path.exists(os.path.join(self.download_mod_directory, modid, WINDOWS_NOEDITOR)):
-            print_error("Mod directory does not exist in local mod repository")
+            self.record(modid, error="Mod directory does not exist in local mod repository")
             return False
 
         try:
             srcdir = os.path.join(self.download_mod_directory, modid, WINDOWS_NOEDITOR)
-            destdir = os.path.join(self.workdir, modid)
+            destdir = os.path.join(workdir, modid)
+            installdir, manifest_path = self.previous_install(modid)
+            previous = {} if self.full_extract or not manifest_path else self.load_manifest(manifest_path)
+            manifest = {}
+            reused = []
+            archives = []
+            tasks = []
+            journal = ExtractJournal(os.path.join(workdir, modid + JOURNAL_SUFFIX))
             for curdir, subdirs, files in os.walk(srcdir):
                 os.makedirs(os.path.join(destdir, os.path.relpath(curdir, srcdir)), 0o770, True)
                 for file in files:
@@ -166,19 +986,27 @@ class ModDodo:
                     if ext == ".z":
                         src = os.path.join(curdir, file)
                         dst = os.path.join(destdir, os.path.relpath(curdir, srcdir), name)
-                        arkit.unpack(src, dst)
-                        shutil.copystat(src,dst)
-                        uncompressed = os.path.join(curdir, file + ".uncompressed_size")
-                        with open(uncompressed, "r") as fd:
-                             unpacked_size = int(fd.read())
-                             if os.stat(dst).st_size != unpacked_size:
-                                print_error ("Wrong file size "+dst)
-                                return False
+                        archives.append((os.path.getsize(src), src, dst))
+                        relpath = os.path.relpath(src, srcdir)
+                        tasks.append((self.extract_file, (modid, src, dst, relpath, installdir, previous.get(relpath), manifest, reused, journal)))
                     if ext == ".info":
                         src = os.path.join(curdir, file)
                         dst = os.path.join(destdir, os.path.relpath(curdir, srcdir), file)
                         shutil.copy2(src, dst)
                         shutil.copystat(src,dst)
+
+            order = sorted(range(len(tasks)), key=lambda i: archives[i][0], reverse=True)
+            try:
+                run_concurrently([tasks[i] for i in order], self.extract_workers)
+            finally:
+                journal.close()
+
+            if reused:
+                print("   * Reused " + str(len(reused)) + " of " + str(len(manifest)) + " unchanged files")
+            if journal.resumed:
+                print("   * Resumed " + str(journal.resumed) + " files of an interrupted extraction")
+            self.write_manifest(os.path.join(workdir, modid + MOD_MANIFEST_SUFFIX), manifest)
+
             for curdir, subdir, files in os.walk(srcdir):
                 dstdirattr = os.path.join(destdir, os.path.relpath(curdir, srcdir))
                 shutil.copystat(curdir,dstdirattr)
@@ -186,30 +1014,148 @@ class ModDodo:
 
             return True
 
-        except (arkit.UnpackException, arkit.SignatureUnpackException, arkit.CorruptUnpackException) as e:
-            print_error(str(e))
+        except (arkit.UnpackException, ExtractException) as e:
+            self.record(modid, error=str(e))
             return False
 
-    def create_mod_file(self, modid):
+    def extract_file(self, modid, src, dst, relpath, installdir, previous, manifest, reused, journal):
+        """
+        Unpack a single .z file and verify its size against the .uncompressed_size file next to it.
+        If the manifest entry of the last install matches the source, the installed output is reused instead and
+        relpath is appended to reused. The new manifest entry is stored in manifest under relpath.
+        Unpacking resumes after the chunks the journal of an interrupted attempt recorded and that check out in dst,
+        and records its own progress there. Files of at least PATCH_MIN_SIZE bytes keep the digests of their compressed
+        chunks in the manifest, so that the next version only decompresses the chunks that changed and copies the
+        others from the installed file.
+        """
+        st = os.stat(src)
+        output = os.path.splitext(relpath)[0]
+        installed = os.path.join(installdir, output) if installdir else None
+        start = time.perf_counter()
+        with open(src + ".uncompressed_size", "r") as fd:
+            unpacked_size = int(fd.read())
+        self.metrics.add(modid, "verify", time.perf_counter() - start)
+        chunks = None
+        content_hash = self.unchanged_hash(src, st, installed, previous)
+        if content_hash:
+            if os.path.lexists(dst):
+                os.remove(dst)
+            link_or_copy(installed, dst, self.governor)
+            chunks = previous.get("chunks")
+        else:
+            resume, content_hash = journal.resume(relpath, src, st, dst)
+            if not content_hash:
+                content_hash = file_hash(src)
+                progress = functools.partial(self.progress, modid) if self.progress else None
+                if unpacked_size >= PATCH_MIN_SIZE:
+                    chunks = []
+                patch = not resume and self.patchable(installed, previous)
+                if not resume and os.path.lexists(dst):
+                    # Write a new file, the workdir may still hold a link to the installed one from an earlier attempt
+                    os.remove(dst)
+                with self.governor.slot(self.extract_workers), self.governor.output(dst, progress) as progress:
+                    if patch:
+                        self.metrics.patch(modid, src, dst, installed, previous["chunks"], workers=self.chunk_workers, progress=progress, digests=chunks)
+                    else:
+                        checkpoint = functools.partial(journal.checkpoint, relpath, st)
+                        self.metrics.unpack(modid, src, dst, workers=self.chunk_workers, progress=progress, resume=resume, checkpoint=checkpoint, digests=chunks)
+                journal.finished(relpath, st, content_hash)
+            reused = None
+        shutil.copystat(src,dst)
+        start = time.perf_counter()
+        if os.stat(dst).st_size != unpacked_size:
+            raise ExtractException("Wrong file size " + dst)
+        self.metrics.add(modid, "verify", time.perf_counter() - start)
+        manifest[relpath] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "hash": content_hash,
+                             "output": output, "output_size": unpacked_size}
+        if chunks:
+            manifest[relpath]["chunks"] = chunks
+        if reused is not None:
+            reused.append(relpath)
+
+    def patchable(self, installed, previous):
+        """
+        Check whether a changed .z file can be unpacked with arkit.patch from the installed output of its last version,
+        which needs the chunk digests recorded in the manifest for files of at least PATCH_MIN_SIZE bytes.
+        """
+        if not previous or not previous.get("chunks") or not installed or not os.path.isfile(installed):
+            return False
+        return os.path.getsize(installed) == previous.get("output_size") == sum(size for digest, size in previous["chunks"])
+
+    def unchanged_hash(self, src, st, installed, previous):
+        """
+        Check a .z file against its manifest entry from the last install.
+        Size and mtime are trusted when both match, otherwise the content hash decides.
+        :returns the content hash if the installed output can be reused, otherwise None
+        """
+        if not previous or not os.path.isfile(installed) or os.path.getsize(installed) != previous.get("output_size"):
+            return None
+        if previous.get("size") != st.st_size:
+            return None
+        if previous.get("mtime_ns") == st.st_mtime_ns:
+            return previous.get("hash")
+        content_hash = file_hash(src)
+        if content_hash == previous.get("hash"):
+            return content_hash
+        return None
+
+    def load_manifest(self, path):
+        """
+        Read the manifest written by the last install of a mod.
+        :returns dict of .z path -> entry, empty if there is no usable manifest
+        """
+        return self.read_manifest(path).get("files", {})
+
+    def read_manifest(self, path):
+        """
+        :returns the whole manifest of a mod, with the files and what create_mod_file and prepare_mod added, or {}
+        """
+        try:
+            with open(path, "r") as f:
+                manifest = json.load(f)
+            if manifest.get("version") == MOD_MANIFEST_VERSION and isinstance(manifest.get("files"), dict):
+                return manifest
+        except (OSError, ValueError, AttributeError):
+            pass
+        return {}
+
+    def write_manifest(self, path, manifest, **fields):
+        with open(path, "w") as f:
+            json.dump(dict(fields, version=MOD_MANIFEST_VERSION, files=manifest), f, indent=1, sort_keys=True)
+
+    def update_manifest(self, path, **fields):
+        """
+        Add fields to the manifest in a workdir.
+        """
+        manifest = self.read_manifest(path)
+        manifest.update(fields)
+        self.write_manifest(path, manifest.pop("files", {}), **{k: v for k, v in manifest.items() if k != "version"})
+
+    def create_mod_file(self, modid, workdir):
         """
         Create the .mod file.
         This code is an adaptation of the code from Ark Server Launcher.  All credit goes to Face Wound on Steam
         """
-        print("- Writing .mod file...")
-        if not self.parse_base_info(modid) or not self.parse_meta_data(modid):
+        print("- Writing .mod file for mod " + str(modid) + "...")
+        map_names = self.parse_base_info(modid)
+        meta_data = self.parse_meta_data(modid)
+        if map_names is None or meta_data is None:
             return False
 
-        with open(os.path.join(self.workdir, modid+".mod"), "w+b") as f:
+        # Keep what was parsed for the catalog, so it never has to be parsed again
+        self.update_manifest(os.path.join(workdir, modid + MOD_MANIFEST_SUFFIX), map_names=map_names, meta_data=list(meta_data.items()))
+
+        with open(os.path.join(workdir, modid+".mod"), "w+b") as f:
 
             modid = int(modid)
             f.write(struct.pack('Ixxxx', modid))  # Needs 4 pad bits
             self.write_ue4_string("ModName", f)
             self.write_ue4_string("", f)
 
-            map_count = len(self.map_names)
+            map_count = len(map_names)
             f.write(struct.pack("i", map_count))
 
-            for m in self.map_names:
+            for m in map_names:
                 self.write_ue4_string(m, f)
 
             # Not sure of the reason for this
@@ -218,55 +1164,105 @@ class ModDodo:
             num3 = 2
             f.write(struct.pack('i', num3))
 
-            if "ModType" in self.meta_data:
+            if "ModType" in meta_data:
                 mod_type = b'1'
             else:
                 mod_type = b'0'
 
             # TODO The packing on this char might need to be changed
             f.write(struct.pack('p', mod_type))
-            meta_length = len(self.meta_data)
+            meta_length = len(meta_data)
             f.write(struct.pack('i', meta_length))
 
-            for k, v in self.meta_data.items():
+            for k, v in meta_data.items():
                 self.write_ue4_string(k, f)
                 self.write_ue4_string(v, f)
 
         return True
 
-    def move_mod(self, modid):
+    def move_mod(self, modid, workdir, server_directory, link=False):
         """
         Move mod from SteamCMD download location to the ARK server.
-        It will delete an existing mod with the same ID
+        With link the workdir is left untouched and the server gets hardlinks (or reflinks/copies) of its files instead.
+        The new mod is assembled in the staging directory next to the live one, on the same file system, and swapped in
+        with renames: the mod directory is exchanged atomically where the kernel supports it and the .mod file is replaced
+        atomically. The old version is deleted in the background.
         """
 
-        print("- Moving mod...")
+        print("- Moving mod " + str(modid) + "...")
 
-        ark_mod_directory = os.path.join(self.server_directory, SERVER_MOD_DIRECTORY)
+        ark_mod_directory = os.path.join(server_directory, SERVER_MOD_DIRECTORY)
         target_mod_directory = os.path.join(ark_mod_directory, str(modid))
-        source_mod_directory = os.path.join(self.workdir)
+        source_mod_directory = os.path.join(workdir)
 
         try:
-            if not os.path.isdir(ark_mod_directory):
-                    os.mkdir(ark_mod_directory)
-
-            if os.path.isdir(target_mod_directory):
-                shutil.rmtree(target_mod_directory)
-
-            shutil.move(os.path.join(source_mod_directory, str(modid)), target_mod_directory)
-
-            shutil.move(os.path.join(source_mod_directory, str(modid)+".mod"), os.path.join(ark_mod_directory, str(modid)+".mod"))
-            os.chmod(os.path.join(ark_mod_directory, str(modid)+".mod"), 0o600)
-            os.chmod(os.path.join(target_mod_directory, "modmeta.info"), 0o660)
-            os.chmod(os.path.join(target_mod_directory, "mod.info"), 0o660)
-            shutil.copystat(os.path.join(target_mod_directory, "mod.info"), os.path.join(ark_mod_directory, str(modid)+".mod"))
+            staging = tempfile.mkdtemp(prefix=str(modid) + "-", dir=self.staging_directory(server_directory))
+            new_mod_directory = os.path.join(staging, str(modid))
 
+            transfer = functools.partial(link_or_copy, governor=self.governor) if link else shutil.move
+            if link:
+                link_tree(os.path.join(source_mod_directory, str(modid)), new_mod_directory, self.governor)
+            else:
+                shutil.move(os.path.join(source_mod_directory, str(modid)), new_mod_directory)
+
+            for name in (str(modid)+".mod", str(modid) + MOD_MANIFEST_SUFFIX):
+                if os.path.isfile(os.path.join(source_mod_directory, name)):
+                    transfer(os.path.join(source_mod_directory, name), os.path.join(staging, name))
+            os.chmod(os.path.join(staging, str(modid)+".mod"), 0o600)
+            os.chmod(os.path.join(new_mod_directory, "modmeta.info"), 0o660)
+            os.chmod(os.path.join(new_mod_directory, "mod.info"), 0o660)
+            shutil.copystat(os.path.join(new_mod_directory, "mod.info"), os.path.join(staging, str(modid)+".mod"))
+
+            swap_directory(new_mod_directory, target_mod_directory)
+            for name in (str(modid)+".mod", str(modid) + MOD_MANIFEST_SUFFIX):
+                if os.path.isfile(os.path.join(staging, name)):
+                    os.replace(os.path.join(staging, name), os.path.join(ark_mod_directory, name))
+
+            # staging now holds the old version, if there was one
+            self.defer_cleanup(staging)
             return True
         except Exception as e:
-            print_error("Encountered unexpected exception during move operation from " + source_mod_directory + " to " + ark_mod_directory + ":\n"
+            self.record(modid, error="Encountered unexpected exception during move operation from " + source_mod_directory + " to " + ark_mod_directory + ":\n"
                         + str(e))
             return False
 
+    def staging_directory(self, server_directory):
+        """
+        Staging directory inside the server's mod directory, so renames into place never cross file systems.
+        Leftovers of interrupted runs older than STAGING_STALE_AGE are removed in the background.
+        """
+        staging = os.path.join(server_directory, SERVER_MOD_DIRECTORY, STAGING_DIRECTORY)
+        os.makedirs(staging, 0o770, True)
+        with self.cleanup_lock:
+            if staging in self.checked_staging:
+                return staging
+            self.checked_staging.add(staging)
+        now = time.time()
+        for name in os.listdir(staging):
+            path = os.path.join(staging, name)
+            if now - os.path.getmtime(path) <= STAGING_STALE_AGE:
+                continue
+            if name.endswith(PARTIAL_SUFFIX):
+                self.discard_partial(path)
+            else:
+                self.defer_cleanup(path)
+        return staging
+
+    def defer_cleanup(self, path):
+        """
+        Delete path in a background thread; wait_for_cleanup() joins them before the run ends.
+        """
+        thread = threading.Thread(target=shutil.rmtree, args=(path, True))
+        thread.start()
+        with self.cleanup_lock:
+            self.cleanup_threads.append(thread)
+
+    def wait_for_cleanup(self):
+        with self.cleanup_lock:
+            threads, self.cleanup_threads = self.cleanup_threads, []
+        for thread in threads:
+            thread.join()
+
     def read_ue4_string(self, file):
         count = struct.unpack('i', file.read(4))[0]
         flag = False
@@ -296,14 +1292,15 @@ class ModDodo:
             4. Read next 4 bytes to tell how many bytes to read ahead to get value
             5. Read ahead by the number of bytes retrieved from step 4
             6. Start at step 2 again
-        :return: Dict
+        :return: OrderedDict, or None if modmeta.info is missing
         """
 
         mod_meta = os.path.join(self.download_mod_directory, modid, WINDOWS_NOEDITOR_MODMETA_INFO)
         if not os.path.isfile(mod_meta):
-            print_error("Could not find " + WINDOWS_NOEDITOR_MODMETA_INFO + " in " + self.download_mod_directory + "/" + modid)
-            return False
+            self.record(modid, error="Could not find " + WINDOWS_NOEDITOR_MODMETA_INFO + " in " + self.download_mod_directory + "/" + modid)
+            return None
 
+        meta_data = OrderedDict([])
         with open(mod_meta, "rb") as f:
 
             total_pairs = struct.unpack('i', f.read(4))[0]
@@ -338,17 +1335,22 @@ class ModDodo:
 
                 if key and value:
                     print("   * " + key + " = " + value)
-                    self.meta_data[key] = value
+                    meta_data[key] = value
 
-        return True
+        return meta_data
 
     def parse_base_info(self, modid):
+        """
+        Parse the map names from mod.info.
+        :return: list of map names, or None if mod.info is missing
+        """
         mod_info = os.path.join(self.download_mod_directory, modid, WINDOWS_NOEDITOR_MOD_INFO)
 
         if not os.path.isfile(mod_info):
-            print_error("Could not find " + WINDOWS_NOEDITOR_MOD_INFO + " in " + self.download_mod_directory + "/" + modid)
-            return False
+            self.record(modid, error="Could not find " + WINDOWS_NOEDITOR_MOD_INFO + " in " + self.download_mod_directory + "/" + modid)
+            return None
 
+        map_names = []
         with open(mod_info, "rb") as f:
             self.read_ue4_string(f)
             map_count = struct.unpack('i', f.read(4))[0]
@@ -356,9 +1358,779 @@ class ModDodo:
             for i in range(map_count):
                 cur_map = self.read_ue4_string(f)
                 if cur_map:
-                    self.map_names.append(cur_map)
+                    map_names.append(cur_map)
+
+        return map_names
+
+
+class ModDodoException(Exception):
+    pass
+
+
+class ExtractException(Exception):
+    pass
+
+
+class ModCatalog:
+    """
+    Persistent catalog of the mods installed on one server, kept as JSON in ShooterGame/Content/Mods/.moddodo-catalog.json.
+    It records for every installed mod its version, when it was installed, the map names from mod.info, the modmeta.info
+    pairs and the installed files, so deciding whether a mod is up to date is a lookup instead of re-parsing its files.
+    Writers lock the catalog, so several ModDodo instances or processes can install on the same server.
+    """
+
+    def __init__(self, server_directory):
+        self.path = os.path.join(server_directory, SERVER_MOD_DIRECTORY, CATALOG_FILE)
+        self.lock = threading.Lock()
+        self.exists = False
+        self.mods = OrderedDict()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                catalog = json.load(f, object_pairs_hook=OrderedDict)
+            if catalog.get("version") == CATALOG_VERSION:
+                self.mods = catalog["mods"]
+                self.exists = True
+        except (OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    def get(self, modid):
+        with self.lock:
+            return self.mods.get(modid)
+
+    def record(self, modid, entry):
+        """
+        Store the entry of a freshly installed mod and write the catalog right away.
+        """
+        with self.update():
+            self.mods[modid] = entry
 
+    def remove(self, modids):
+        """
+        Forget mods that are no longer installed and write the catalog right away.
+        """
+        with self.update():
+            for modid in modids:
+                self.mods.pop(modid, None)
+
+    @contextlib.contextmanager
+    def update(self):
+        os.makedirs(os.path.dirname(self.path), 0o770, True)
+        with self.lock, open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Keep what others recorded since this catalog was read
+            self.load()
+            yield
+            self.exists = True
+            self.save()
+
+    def save(self):
+        temp = self.path + ".tmp"
+        with open(temp, "w") as f:
+            json.dump({"version": CATALOG_VERSION, "mods": self.mods}, f, indent=1)
+        os.replace(temp, self.path)
+
+
+def catalog_entry(manifest):
+    """
+    Build the catalog entry of an installed mod from the manifest of its extraction.
+    """
+    files = sorted(entry["output"] for entry in manifest.get("files", {}).values())
+    return OrderedDict([
+        ("version", manifest.get("mod_version")),
+        ("workshop_manifest", manifest.get("workshop_manifest")),
+        ("installed", int(time.time())),
+        ("map_names", manifest.get("map_names", [])),
+        ("meta_data", manifest.get("meta_data", [])),
+        ("files", ["mod.info", "modmeta.info"] + files),
+    ])
+
+
+class WorkshopWatcher:
+    """
+    Reports which mods in the local mod directory changed. Every mod directory is watched with inotify
+    (through libc, no extra module needed); where inotify is not available or runs out of watches, the
+    directory is polled every WATCH_POLL_INTERVAL seconds instead and mods are compared by their version.
+    """
+
+    def __init__(self, directory, modids, version):
+        self.directory = directory
+        self.modids = modids
+        self.version = version
+        self.fd = None
+        self.watches = {}
+        self.versions = None
+        self.next_poll = 0
+        try:
+            self.libc = ctypes.CDLL(None, use_errno=True)
+            fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            fd = -1
+        if fd >= 0 and os.path.isdir(directory):
+            self.fd = fd
+            self.add_tree(directory)
+        elif fd >= 0:
+            os.close(fd)
+        if self.fd is None:
+            self.poll()
+
+    @property
+    def polling(self):
+        return self.fd is None
+
+    def add_tree(self, path):
+        for curdir, subdirs, files in os.walk(path):
+            if self.fd is None:
+                return
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(curdir), IN_WATCH_MASK)
+            if wd >= 0:
+                self.watches[wd] = curdir
+            elif ctypes.get_errno() not in (errno.ENOENT, errno.ENOTDIR):
+                # Most likely fs.inotify.max_user_watches is exhausted
+                print_error("Could not watch " + curdir + ", falling back to polling:\n" + os.strerror(ctypes.get_errno()))
+                self.close()
+
+    def wait(self, timeout=None):
+        """
+        Wait up to timeout seconds, forever if None, for changes.
+        :returns set of mod ids that changed, empty on timeout
+        """
+        if self.fd is not None:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+            if not readable:
+                return set()
+            changed = self.read_events()
+            if changed is not None:
+                return changed
+            # The kernel dropped events or the watches ran out, so every mod has to be compared once
+            changed = set(self.modids())
+            if self.fd is None:
+                self.poll()
+            return changed
+        delay = max(self.next_poll - time.monotonic(), 0)
+        if timeout is not None and timeout < delay:
+            time.sleep(timeout)
+            return set()
+        time.sleep(delay)
+        return self.poll()
+
+    def read_events(self):
+        """
+        :returns set of mod ids with events, None if the kernel dropped events or watching failed
+        """
+        changed = set()
+        while self.fd is not None:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + 16 <= len(data):
+                wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+                name = data[offset + 16:offset + 16 + length].rstrip(b"\0")
+                offset += 16 + length
+                if mask & IN_Q_OVERFLOW:
+                    changed = None
+                    continue
+                path = self.watches.get(wd)
+                if path is None:
+                    continue
+                if mask & IN_IGNORED:
+                    del self.watches[wd]
+                    continue
+                path = os.path.join(path, os.fsdecode(name)) if name else path
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(path)
+                relpath = os.path.relpath(path, self.directory)
+                if changed is not None and relpath != os.curdir:
+                    changed.add(relpath.split(os.sep)[0])
+        return changed if self.fd is not None else None
+
+    def poll(self):
+        """
+        Compare the version of every mod with the last poll. The first poll only records them.
+        """
+        versions = {modid: self.version(modid) for modid in self.modids()}
+        changed = set() if self.versions is None else {modid for modid, version in versions.items() if self.versions.get(modid) != version}
+        self.versions = versions
+        self.next_poll = time.monotonic() + WATCH_POLL_INTERVAL
+        return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self.watches = {}
+
+
+class ExtractJournal:
+    """
+    Append-only NDJSON journal of an extraction, kept in its workdir so that the next attempt at the same mod version
+    can resume after an interruption. Every .z file gets "chunks" records with the CRC-32 of each unpacked chunk, one
+    per arkit.unpack checkpoint, and a "file" record with its content hash when it is done. Records are flushed but
+    not fsynced: before anything is reused it is checked against the CRC-32s, so whatever a crash lost is redone.
+    A last line torn by the interruption is cut off before new records are appended.
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.files = {}
+        self.resumed = 0
+        complete = 0
+        try:
+            with open(path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    complete += len(line)
+                    try:
+                        self.replay(json.loads(line))
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        continue
+        except OSError:
+            pass
+        self.file = open(path, "a")
+        self.file.truncate(complete)
+
+    def replay(self, record):
+        state = self.state(record["file"], record["size"], record["mtime_ns"])
+        if record["type"] == "chunks" and record["first"] <= len(state["crcs"]):
+            del state["crcs"][record["first"]:]
+            state["crcs"].extend(int(crc) for crc in record["crcs"])
+            state["hash"] = None
+        elif record["type"] == "file":
+            state["hash"] = record["hash"]
+
+    def state(self, relpath, size, mtime_ns):
+        """
+        What is known about a file, reset if the source changed since.
+        """
+        state = self.files.get(relpath)
+        if state is None or state["source"] != [size, mtime_ns]:
+            state = self.files[relpath] = {"source": [size, mtime_ns], "crcs": [], "hash": None}
+        return state
+
+    def resume(self, relpath, src, st, dst):
+        """
+        Check the output of an earlier attempt at src against the journal.
+        :returns (number of leading chunks of dst that can be kept, content hash if dst is complete, else None)
+        """
+        with self.lock:
+            state = self.state(relpath, st.st_size, st.st_mtime_ns)
+            crcs = state["crcs"]
+        # Never write into a dst that is linked elsewhere, e.g. to the installed mod by an attempt that reused it
+        if not crcs or not os.path.isfile(dst) or os.stat(dst).st_nlink > 1:
+            return 0, None
+        actual = arkit.unpacked_crcs(src, dst, len(crcs))
+        verified = 0
+        while verified < len(actual) and actual[verified] == crcs[verified]:
+            verified += 1
+        with self.lock:
+            complete = state["hash"] if verified == len(crcs) else None
+            del crcs[verified:]
+            if verified:
+                self.resumed += 1
+        return verified, complete
+
+    def checkpoint(self, relpath, st, first, crcs):
+        with self.lock:
+            self.replay_and_write({"type": "chunks", "file": relpath, "size": st.st_size, "mtime_ns": st.st_mtime_ns, "first": first, "crcs": crcs})
+
+    def finished(self, relpath, st, content_hash):
+        with self.lock:
+            self.replay_and_write({"type": "file", "file": relpath, "size": st.st_size, "mtime_ns": st.st_mtime_ns, "hash": content_hash})
+
+    def replay_and_write(self, record):
+        self.replay(record)
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class Metrics:
+    """
+    Collects wall time per mod and phase plus I/O counters of a run, optionally written to an NDJSON file.
+    Timed phases (download, extract, modfile, move) are written as one line each when they end. Per-file work (unpack,
+    verify) is only accumulated, since it overlaps on the worker threads. close() writes one summary line per mod and
+    one for the whole run. With profile_path, every arkit.unpack and arkit.patch call runs under cProfile, one at a
+    time, and the merged stats are dumped there on close().
+    """
+
+    def __init__(self, path=None, profile_path=None):
+        self.lock = threading.Lock()
+        self.file = open(path, "a") if path else None
+        self.profile_path = profile_path
+        self.profile_lock = threading.Lock()
+        self.profile_stats = None
+        self.mods = OrderedDict()
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, modid, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(modid, name, time.perf_counter() - start, write=True)
+
+    def add(self, modid, phase=None, seconds=0.0, write=False, **counters):
+        """
+        Add seconds to a phase and/or counters of a mod. With write, the phase is also written as its own line.
+        """
+        with self.lock:
+            mod = self.mods.setdefault(modid, {"phases": OrderedDict(), "counters": OrderedDict()})
+            if phase:
+                mod["phases"][phase] = mod["phases"].get(phase, 0.0) + seconds
+            for name, value in counters.items():
+                mod["counters"][name] = mod["counters"].get(name, 0) + value
+            if write:
+                self.write(dict({"event": "phase", "mod": modid, "phase": phase, "seconds": round(seconds, 6)}, **counters))
+
+    def unpack(self, modid, src, dst, **kwargs):
+        """
+        arkit.unpack with its time, chunk count and bytes read/written accounted to the mod.
+        """
+        return self.run_unpack(arkit.unpack, modid, src, dst, **kwargs)
+
+    def patch(self, modid, src, dst, base, base_chunks, **kwargs):
+        """
+        arkit.patch, accounted like unpack, plus the patched file and the bytes copied from the installed file.
+        """
+        stats = self.run_unpack(arkit.patch, modid, src, dst, base, base_chunks, **kwargs)
+        self.add(modid, patched=1, bytes_copied=os.path.getsize(dst) - stats.bytes_written)
+        return stats
+
+    def run_unpack(self, function, modid, src, dst, *args, **kwargs):
+        start = time.perf_counter()
+        if self.profile_path:
+            # Since Python 3.12 only one profiler can be active at a time, so profiled unpacks run one after another
+            with self.profile_lock:
+                profile = cProfile.Profile()
+                stats = profile.runcall(function, src, dst, *args, **kwargs)
+            with self.lock:
+                if self.profile_stats is None:
+                    self.profile_stats = pstats.Stats(profile)
+                else:
+                    self.profile_stats.add(profile)
+        else:
+            stats = function(src, dst, *args, **kwargs)
+        self.add(modid, "unpack", time.perf_counter() - start, files=1, chunks=stats.chunks, bytes_read=stats.bytes_read, bytes_written=stats.bytes_written)
+        return stats
+
+    def write(self, record):
+        if self.file:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            totals = OrderedDict()
+            for modid, mod in self.mods.items():
+                record = OrderedDict([("event", "mod"), ("mod", modid)])
+                record["phases"] = OrderedDict((name, round(seconds, 6)) for name, seconds in mod["phases"].items())
+                record.update(mod["counters"])
+                unpack_seconds = mod["phases"].get("unpack", 0.0)
+                if unpack_seconds and mod["counters"].get("bytes_written"):
+                    record["unpack_mib_per_second"] = round(mod["counters"]["bytes_written"] / unpack_seconds / (1024 * 1024), 3)
+                for name, value in mod["counters"].items():
+                    totals[name] = totals.get(name, 0) + value
+                self.write(record)
+            self.write(dict({"event": "run", "mods": len(self.mods), "seconds": round(time.perf_counter() - self.start, 6), "codec": arkit.get_codec()}, **totals))
+            if self.file:
+                self.file.close()
+                self.file = None
+            if self.profile_stats is not None:
+                self.profile_stats.dump_stats(self.profile_path)
+
+
+class ResourceGovernor:
+    """
+    Keeps installs from stalling game servers running on the same host. Every limit is optional:
+    - write_rate: bytes per second of decompressed or copied data written, shared by all threads and all ModDodo
+      instances using the same governor
+    - sync_bytes: whenever that many bytes were written to an output file, its data is flushed with fdatasync and
+      dropped from the page cache with posix_fadvise(DONTNEED), and once more when it is finished, so dirty pages
+      do not pile up and the written data does not push the servers' own files out of the cache
+    - target_load: the number of files unpacked at the same time is lowered by one every GOVERNOR_INTERVAL seconds
+      while the 1 minute load average is above it and raised again while there is room for one more
+    - nice and ionice ("idle" or a best-effort level 0-7): priority of the thread calling apply_priority and every
+      thread it starts afterwards
+    """
+
+    def __init__(self, write_rate=None, sync_bytes=None, target_load=None, nice=None, ionice=None):
+        self.write_rate = write_rate
+        self.sync_bytes = sync_bytes
+        self.target_load = target_load
+        self.nice = nice
+        self.ionice = ionice
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.next_write = 0.0
+        self.active = 0
+        self.concurrency = None
+        self.checked = 0.0
+
+    def apply_priority(self):
+        """
+        Set nice and ionice. On Linux both only apply to the calling thread, but threads started later inherit them,
+        so this is called before a run starts its pools. nice is never lowered, which would need privileges.
+        """
+        if self.nice is not None and self.nice > os.getpriority(os.PRIO_PROCESS, 0):
+            os.setpriority(os.PRIO_PROCESS, 0, self.nice)
+        if self.ionice is not None:
+            if self.ionice == "idle":
+                ioprio = IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+            else:
+                ioprio = IOPRIO_CLASS_BE << IOPRIO_CLASS_SHIFT | int(self.ionice)
+            number = SYS_IOPRIO_SET.get(os.uname().machine)
+            libc = ctypes.CDLL(None, use_errno=True)
+            if number is None or libc.syscall(number, IOPRIO_WHO_PROCESS, 0, ioprio) != 0:
+                print_error("Could not set the I/O priority: " + (os.strerror(ctypes.get_errno()) if number else "unknown system call number"))
+
+    @contextlib.contextmanager
+    def slot(self, workers):
+        """
+        Wait until fewer than the currently allowed number of files, at most workers, are being unpacked.
+        """
+        if self.target_load is None:
+            yield
+            return
+        with self.condition:
+            while self.active >= self.allowed(workers):
+                self.condition.wait(GOVERNOR_INTERVAL)
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+    def allowed(self, workers):
+        """
+        Adapt the concurrency to the load average, at most every GOVERNOR_INTERVAL seconds. Called with the lock held.
+        """
+        now = time.monotonic()
+        if self.concurrency is None:
+            self.concurrency = workers
+        if now - self.checked >= GOVERNOR_INTERVAL:
+            self.checked = now
+            load = os.getloadavg()[0]
+            if load > self.target_load:
+                self.concurrency = max(1, self.concurrency - 1)
+            elif load + 1 <= self.target_load:
+                self.concurrency = min(workers, self.concurrency + 1)
+        return min(self.concurrency, workers)
+
+    def throttle(self, size):
+        """
+        Account size bytes written and sleep as long as the writes are ahead of write_rate, allowing a burst of
+        GOVERNOR_BURST seconds.
+        """
+        if not self.write_rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.next_write = max(self.next_write, now - GOVERNOR_BURST) + size / self.write_rate
+            delay = self.next_write - now
+        if delay > 0:
+            time.sleep(delay)
+
+    @contextlib.contextmanager
+    def output(self, path, progress=None):
+        """
+        Wrap the progress callable of an arkit.unpack or arkit.patch, or of a copy, into path so that it is throttled
+        and the file is synced every sync_bytes bytes and when done.
+        """
+        if not self.write_rate and not self.sync_bytes:
+            yield progress
+            return
+        lock = threading.Lock()
+        unsynced = [0]
+
+        def written(size):
+            if progress is not None:
+                progress(size)
+            self.throttle(size)
+            if self.sync_bytes:
+                with lock:
+                    unsynced[0] += size
+                    due = unsynced[0] >= self.sync_bytes
+                    if due:
+                        unsynced[0] = 0
+                if due:
+                    self.sync(path)
+
+        yield written
+        if self.sync_bytes:
+            self.sync(path)
+
+    def sync(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except (AttributeError, OSError):
+            pass
+        finally:
+            os.close(fd)
+
+
+def existing_parent(path):
+    """
+    :returns path or its nearest parent that exists, e.g. to find the file system a directory will be created on
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+
+def file_hash(path):
+    """
+    Fast content hash of a file, used to recognise unchanged .z files.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def reflink(src, dst):
+    """
+    Clone src to dst with the FICLONE ioctl (btrfs, XFS, ...), so both share their data blocks until modified.
+    :returns false, if the file system does not support it
+    """
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        shutil.copystat(src, dst)
         return True
+    except OSError:
+        if os.path.lexists(dst):
+            os.remove(dst)
+        return False
+
+
+def copy_file(src, dst, governor=None):
+    """
+    Copy src to dst inside the kernel with copy_file_range, falling back to sendfile and then a plain copy.
+    With a governor that limits writes, the copy goes in GOVERNOR_COPY_SIZE steps that are throttled and synced
+    like extracted data.
+    """
+    output = governor.output(dst) if governor else contextlib.nullcontext()
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst, output as written:
+        size = os.fstat(fsrc.fileno()).st_size
+        step = GOVERNOR_COPY_SIZE if written else size
+        offset = 0
+        try:
+            while offset < size:
+                copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), min(step, size - offset))
+                if not copied:
+                    break
+                offset += copied
+                if written:
+                    written(copied)
+        except (AttributeError, OSError):
+            try:
+                while offset < size:
+                    copied = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, min(step, size - offset))
+                    if not copied:
+                        break
+                    offset += copied
+                    if written:
+                        written(copied)
+            except (AttributeError, OSError):
+                fsrc.seek(offset)
+                fdst.seek(offset)
+                if not written:
+                    shutil.copyfileobj(fsrc, fdst)
+                for block in iter(lambda: fsrc.read(1024 * 1024), b""):
+                    fdst.write(block)
+                    fdst.flush()
+                    written(len(block))
+    shutil.copystat(src, dst)
+
+
+def link_or_copy(src, dst, governor=None):
+    """
+    Hardlink src to dst. If both are not on the same file system, reflink it or as last resort copy it, paced by
+    the governor.
+    """
+    try:
+        os.link(src, dst)
+    except OSError:
+        if not reflink(src, dst):
+            copy_file(src, dst, governor)
+
+
+def rename_exchange(a, b):
+    """
+    Atomically exchange two paths with renameat2(RENAME_EXCHANGE).
+    :returns false, if the kernel, libc or file system does not support it
+    """
+    try:
+        renameat2 = ctypes.CDLL(None, use_errno=True).renameat2
+    except (OSError, AttributeError):
+        return False
+    renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+    return renameat2(AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b), RENAME_EXCHANGE) == 0
+
+
+def swap_directory(new, target):
+    """
+    Put the directory new in place of target. Afterwards the old target, if any, is found at new
+    (or new + ".old" when the exchange had to be done with two renames).
+    """
+    if not os.path.lexists(target):
+        os.rename(new, target)
+    elif not rename_exchange(new, target):
+        os.rename(target, new + ".old")
+        os.rename(new, target)
+
+
+def link_tree(src, dst, governor=None):
+    """
+    Recreate the directory tree src at dst with link_or_copy for every file.
+    """
+    for curdir, subdirs, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(curdir, src))
+        os.makedirs(target, 0o770, True)
+        for file in files:
+            link_or_copy(os.path.join(curdir, file), os.path.join(target, file), governor)
+    for curdir, subdirs, files in os.walk(src, topdown=False):
+        shutil.copystat(curdir, os.path.join(dst, os.path.relpath(curdir, src)))
+
+
+def run_concurrently(tasks, workers):
+    """
+    Run (function, args) tasks on a pool of worker threads, submitting them in the given order.
+    The first exception cancels every task that has not started yet, waits for the running ones and is re-raised.
+    """
+    if workers <= 1 or len(tasks) <= 1:
+        for function, args in tasks:
+            function(*args)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(function, *args) for function, args in tasks]
+        done, not_done = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+        for future in not_done:
+            future.cancel()
+        concurrent.futures.wait(not_done)
+        for future in futures:
+            if future.done() and not future.cancelled() and future.exception() is not None:
+                raise future.exception()
+
+
+def parse_steamcmd_line(line):
+    """
+    Recognise the SteamCMD messages about the result of a workshop download.
+    :returns (STEAMCMD_SUCCESS, modid, path) or (STEAMCMD_FAILURE, modid, reason), None for any other line
+    """
+    match = STEAMCMD_SUCCESS_PATTERN.search(line)
+    if match:
+        return STEAMCMD_SUCCESS, match.group(1), match.group(2)
+    match = STEAMCMD_FAILURE_PATTERN.search(line)
+    if match:
+        return STEAMCMD_FAILURE, match.group(1), match.group(2)
+    match = STEAMCMD_TIMEOUT_PATTERN.search(line)
+    if match:
+        return STEAMCMD_FAILURE, match.group(1), "Timeout"
+    return None
+
+
+def parse_acf(text):
+    """
+    Parse a Valve KeyValues text file like SteamCMD's appworkshop_346110.acf.
+    Quoted and bare tokens, escapes, // comments and [$PLATFORM] conditions are understood. Keys are lower-cased
+    as KeyValues keys are case-insensitive, and a repeated key keeps its last value.
+    :returns nested OrderedDict of the keys and values
+    :raises ValueError if the text is malformed or truncated
+    """
+    root = OrderedDict()
+    stack = [root]
+    key = None
+    for match in ACF_TOKEN_PATTERN.finditer(text):
+        quoted, brace, bare, invalid = match.groups()
+        if invalid is not None:
+            raise ValueError("Unexpected " + repr(invalid) + " at offset " + str(match.start()))
+        if brace == "{":
+            if key is None:
+                raise ValueError("Block without a key at offset " + str(match.start()))
+            block = OrderedDict()
+            stack[-1][key] = block
+            stack.append(block)
+            key = None
+        elif brace == "}":
+            if key is not None or len(stack) == 1:
+                raise ValueError("Unexpected '}' at offset " + str(match.start()))
+            stack.pop()
+        elif quoted is not None or bare is not None:
+            token = bare if quoted is None else re.sub(r'\\(.)', lambda m: {"n": "\n", "t": "\t"}.get(m.group(1), m.group(1)), quoted)
+            if key is None:
+                key = token.lower()
+            else:
+                stack[-1][key] = token
+                key = None
+    if key is not None or len(stack) > 1:
+        raise ValueError("Unexpected end of file")
+    return root
+
+
+def read_workshop_manifest(path):
+    """
+    Read the installed workshop items from SteamCMD's appworkshop_346110.acf.
+    An item needs an update if Steam itself already knows of a newer manifest, or flagged the whole app.
+    :returns dict of mod id -> {"manifest", "timeupdated", "size", "needs_update"}, None if the file is missing or malformed
+    """
+    try:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            workshop = parse_acf(f.read()).get("appworkshop")
+    except (OSError, ValueError):
+        return None
+    if not isinstance(workshop, dict):
+        return None
+
+    def block(parent, key):
+        value = parent.get(key)
+        return value if isinstance(value, dict) else {}
+
+    stale = workshop.get("needsupdate", "0") != "0" or workshop.get("needsdownload", "0") != "0"
+    details = block(workshop, "workshopitemdetails")
+    items = OrderedDict()
+    for modid, item in block(workshop, "workshopitemsinstalled").items():
+        detail = block(details, modid)
+        try:
+            timeupdated = int(item["timeupdated"])
+            items[modid] = {"manifest": item["manifest"], "timeupdated": timeupdated, "size": int(item.get("size", 0)),
+                            "needs_update": stale or detail.get("latest_manifest", item["manifest"]) != item["manifest"]
+                            or int(detail.get("latest_timeupdated", timeupdated)) > timeupdated}
+        except (KeyError, ValueError, TypeError, AttributeError):
+            # An item without a usable manifest id or time is simply downloaded again
+            continue
+    return items
+
+
+def workshop_time_updated(modids):
+    """
+    Ask the Steam Web API when the given mods were last updated, with a single anonymous HTTP request.
+    :returns dict of mod id -> time_updated for every mod Steam reported
+    """
+    data = OrderedDict([("itemcount", len(modids))])
+    for index, modid in enumerate(modids):
+        data["publishedfileids[" + str(index) + "]"] = modid
+    request = urllib.request.Request(WORKSHOP_DETAILS_URL, urllib.parse.urlencode(data).encode())
+    with urllib.request.urlopen(request, timeout=WORKSHOP_DETAILS_TIMEOUT) as response:
+        details = json.loads(response.read().decode())["response"]["publishedfiledetails"]
+    return {str(detail["publishedfileid"]): int(detail["time_updated"]) for detail in details
+            if detail.get("result") == 1 and "time_updated" in detail}
 
 
 def print_error(msg):
@@ -367,7 +2139,7 @@ def print_error(msg):
 
 def main():
     parser = argparse.ArgumentParser(description="Installs ARK Linux server mods via SteamCMD")
-    parser.add_argument("--serverdir", default=".", dest="serverdir", help="home directory of the server (containing the /ShooterGame folder)")
+    parser.add_argument("--serverdir", nargs="+", default=["."], dest="serverdir", help="home directory of the server (containing the /ShooterGame folder), several servers can be given at once")
     parser.add_argument("--localmoddir", default=".", dest="localmoddir", help="local directory where steam downloads mods (usually ~/.local/share/Steam/steamapps/workshop/content/346110")
     parser.add_argument("--modids", nargs="+", default=None, dest="modids", help="space-separated list of IDs of mods to install")
     parser.add_argument("--steamcmd", default="/usr/games", dest="steamcmd", help="path to SteamCMD, default: /usr/games")
@@ -375,22 +2147,85 @@ def main():
     parser.add_argument("--force", "-f", default=False, action="store_true", dest="forceupdate", help="force update of mods on -u (also when not newer)")
     parser.add_argument("--deletecache", "-d", default=False, action="store_true", dest="deletecache", help="Delete SteamCMD cache, if used in multi-server environment")
     parser.add_argument("--nodownload", "-nd", default=False, action="store_true", dest="nodownload", help="Skip download via steamcmd")
+    parser.add_argument("--jobs", "-j", type=int, default=0, dest="jobs", help="number of .z files extracted concurrently, 0 uses all cores, default: 0")
+    parser.add_argument("--modjobs", type=int, default=1, dest="modjobs", help="number of mods extracted at the same time while finished mods are moved, default: 1")
+    parser.add_argument("--movejobs", type=int, default=1, dest="movejobs", help="number of mods moved to the server at the same time, default: 1")
+    parser.add_argument("--fullextract", default=False, action="store_true", dest="fullextract", help="unpack every .z file again, even if it did not change since the last install")
+    parser.add_argument("--store", default=None, dest="store", help="shared directory that keeps extracted mods per version, so each version is extracted once and hardlinked into every server")
+    parser.add_argument("--verify", default=False, action="store_true", dest="verify", help="only check downloaded mods against their .uncompressed_size files and the installed files, without extracting (all downloaded mods if no ids are given)")
+    parser.add_argument("--deep", default=False, action="store_true", dest="deepverify", help="with --verify, also decompress every archive in memory and compare its hash with the installed file")
+    parser.add_argument("--metrics", default=None, dest="metrics", help="append per-mod and per-phase timings and byte counts as NDJSON to this file")
+    parser.add_argument("--profile", default=None, dest="profile", help="run every arkit.unpack under cProfile, one at a time, and dump the merged stats to this file")
+    parser.add_argument("--watch", default=False, action="store_true", dest="watch", help="keep running and install mods whenever they change in the local mod directory (all mods there if no ids are given)")
+    parser.add_argument("--codec", default=None, choices=list(arkit.CODECS), dest="codec", help="zlib implementation used for decompression, default: the fastest installed one (isal, zlib-ng, zlib)")
+    parser.add_argument("--chunkworkers", type=int, default=1, dest="chunkworkers", help="threads decompressing the chunks of one large .z file, 0 uses all cores, default: 1")
+    parser.add_argument("--workshopcheck", default=False, action="store_true", dest="workshopcheck", help="ask the Steam Web API which mods have a new version, so SteamCMD only runs when one does")
+    parser.add_argument("--plan", default=False, action="store_true", dest="plan", help="only print a JSON plan of the installation: bytes per mod, disk space needed and free per file system and the estimated time; exits with 1 if it would not fit")
+    parser.add_argument("--reserve", type=int, default=PLAN_RESERVE // (1024 * 1024), dest="reserve", help="MiB that have to stay free on every file system the installation writes to, default: " + str(PLAN_RESERVE // (1024 * 1024)))
+    parser.add_argument("--nospacecheck", default=False, action="store_true", dest="nospacecheck", help="install even if the disk space check fails")
+    parser.add_argument("--writelimit", type=float, default=0, dest="writelimit", help="limit writing decompressed and copied data to this many MiB/s over all threads, 0 is unlimited, default: 0")
+    parser.add_argument("--syncevery", type=int, default=0, dest="syncevery", help="flush extracted and copied files to disk and drop them from the page cache every this many MiB, 0 never does, default: 0")
+    parser.add_argument("--targetload", type=float, default=None, dest="targetload", help="extract fewer files at the same time while the 1 minute load average is above this")
+    parser.add_argument("--nice", type=int, default=None, choices=range(0, 20), metavar="N", dest="nice", help="run with this nice value (0-19)")
+    parser.add_argument("--ionice", default=None, choices=["idle"] + [str(level) for level in range(8)], dest="ionice", help="I/O priority: idle, or a best-effort level from 0 (highest) to 7 (lowest)")
 
     args = parser.parse_args()
 
-    if not args.modids and not args.updatemods:
+    if not args.modids and not args.updatemods and not args.verify and not args.watch and not args.plan:
         print_error("Neither mod ids provided nor update requested. Don't know what to dodo.")
         print(parser.format_help())
         sys.exit(1)
 
-    ModDodo(args.steamcmd,
-            args.modids,
-            args.serverdir,
-            args.localmoddir,
-            args.updatemods,
-            args.deletecache,
-            args.nodownload,
-            args.forceupdate)
+    # With --plan, stdout only gets the plan
+    stdout = sys.stdout
+    if args.plan:
+        sys.stdout = sys.stderr
+
+    try:
+        print("Decompressing with " + arkit.set_codec(args.codec))
+    except ValueError as e:
+        print_error(str(e))
+        sys.exit(1)
+
+    try:
+        dodo = ModDodo(args.steamcmd,
+                       args.serverdir,
+                       args.localmoddir,
+                       args.chunkworkers or None,
+                       args.jobs or None,
+                       max(args.modjobs, 1),
+                       max(args.movejobs, 1),
+                       args.fullextract,
+                       args.store,
+                       args.metrics,
+                       args.profile,
+                       ResourceGovernor(args.writelimit * 1024 * 1024 or None,
+                                        args.syncevery * 1024 * 1024 or None,
+                                        args.targetload,
+                                        args.nice,
+                                        args.ionice),
+                       args.workshopcheck,
+                       args.reserve * 1024 * 1024)
+        if args.plan:
+            plan = dodo.plan(args.modids or ([] if args.updatemods else dodo.downloaded_mods()), args.updatemods, args.forceupdate)
+            print(json.dumps(plan, indent=1), file=stdout)
+            sys.exit(0 if plan["fits"] else 1)
+        result = dodo.run(args.modids,
+                          args.updatemods,
+                          args.deletecache,
+                          args.nodownload,
+                          args.forceupdate,
+                          args.verify,
+                          args.deepverify,
+                          space_check=not args.nospacecheck)
+        if args.watch:
+            dodo.watch(list(result.mods) if args.modids or args.updatemods else [])
+    except ModDodoException as e:
+        print_error(str(e))
+        sys.exit(1)
+
+    if not result.success:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
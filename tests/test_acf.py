@@ -0,0 +1,122 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import moddodo
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def fixture(name):
+    return os.path.join(FIXTURES, name)
+
+
+class ParseAcfTest(unittest.TestCase):
+
+    def test_normal_manifest(self):
+        with open(fixture("appworkshop_346110.acf")) as f:
+            acf = moddodo.parse_acf(f.read())
+        workshop = acf["appworkshop"]
+        self.assertEqual(workshop["appid"], "346110")
+        self.assertEqual(list(workshop["workshopitemsinstalled"]), ["731604991", "1404697612"])
+        self.assertEqual(workshop["workshopitemsinstalled"]["731604991"]["manifest"], "5811001811222333444")
+        self.assertEqual(workshop["workshopitemdetails"]["1404697612"]["latest_manifest"], "9182736455463728190")
+
+    def test_truncated_manifest(self):
+        with open(fixture("appworkshop_346110_truncated.acf")) as f:
+            text = f.read()
+        self.assertRaises(ValueError, moddodo.parse_acf, text)
+        # Cut after a complete value, only the closing braces are missing
+        self.assertRaises(ValueError, moddodo.parse_acf, text[:text.rindex('"1690000000"') + len('"1690000000"')])
+
+    def test_comments_conditions_and_bare_tokens(self):
+        with open(fixture("appworkshop_346110_comments.acf")) as f:
+            workshop = moddodo.parse_acf(f.read())["appworkshop"]
+        self.assertEqual(workshop["appid"], "346110")
+        self.assertEqual(workshop["needsupdate"], "0")
+        item = workshop["workshopitemsinstalled"]["731604991"]
+        self.assertEqual(item["timeupdated"], "1690000000")
+        self.assertEqual(item["title"], 'Structures "Plus"\tS+')
+
+    def test_malformed(self):
+        for text in ['"a" { "b" "c" } }', '{ "b" "c" }', '"a" { "b" "c" } "d"', '"a" { "b" = "c" }']:
+            self.assertRaises(ValueError, moddodo.parse_acf, text)
+
+
+class ReadWorkshopManifestTest(unittest.TestCase):
+
+    def test_needs_update_from_item_details(self):
+        items = moddodo.read_workshop_manifest(fixture("appworkshop_346110.acf"))
+        self.assertEqual(items["731604991"], {"manifest": "5811001811222333444", "timeupdated": 1690000000,
+                                              "size": 1073741824, "needs_update": False})
+        self.assertTrue(items["1404697612"]["needs_update"])
+
+    def test_needs_update_of_the_app(self):
+        items = moddodo.read_workshop_manifest(fixture("appworkshop_346110_needsupdate.acf"))
+        self.assertTrue(items["731604991"]["needs_update"])
+        # Without a time it cannot be compared, so it is left out and downloaded again
+        self.assertNotIn("880000000", items)
+
+    def test_mixed_case_keys(self):
+        items = moddodo.read_workshop_manifest(fixture("appworkshop_346110_comments.acf"))
+        self.assertEqual(items["731604991"]["manifest"], "5811001811222333444")
+        self.assertFalse(items["731604991"]["needs_update"])
+
+    def test_missing_or_truncated(self):
+        self.assertIsNone(moddodo.read_workshop_manifest(fixture("appworkshop_346110_truncated.acf")))
+        self.assertIsNone(moddodo.read_workshop_manifest(fixture("missing.acf")))
+
+
+class OutdatedModsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.workshop = os.path.join(self.root, "steamapps", "workshop")
+        content = os.path.join(self.workshop, "content", moddodo.WORKSHOP_APPID)
+        for modid in ["731604991", "1404697612", "555"]:
+            os.makedirs(os.path.join(content, modid, moddodo.WINDOWS_NOEDITOR))
+        shutil.copy(fixture("appworkshop_346110.acf"), os.path.join(self.workshop, moddodo.WORKSHOP_MANIFEST))
+        self.server = os.path.join(self.root, "server")
+        os.makedirs(os.path.join(self.server, moddodo.SERVER_CHECK_PATH))
+        self.dodo = moddodo.ModDodo(self.root, [self.server], content)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def install(self, modid, manifest):
+        self.dodo.catalogs[self.server].record(modid, {"version": "1", "workshop_manifest": manifest})
+
+    def test_manifest_path(self):
+        self.assertEqual(self.dodo.workshop_manifest_path(), os.path.join(self.workshop, moddodo.WORKSHOP_MANIFEST))
+
+    def test_compared_with_the_catalog(self):
+        # Installed from an older manifest: the newer download is already there
+        self.install("731604991", "1111")
+        # Flagged by Steam, missing from the manifest, never installed
+        self.assertEqual(self.dodo.outdated_mods(["731604991", "1404697612", "555", "777"]), ["1404697612", "555", "777"])
+        # Installed from the downloaded manifest: only SteamCMD knows whether there is a newer one
+        self.install("731604991", "5811001811222333444")
+        self.assertEqual(self.dodo.outdated_mods(["731604991"]), ["731604991"])
+
+    def test_workshop_check(self):
+        self.dodo.workshop_check = True
+        with mock.patch("moddodo.workshop_time_updated", return_value={"731604991": 1690000000}):
+            self.assertEqual(self.dodo.outdated_mods(["731604991"]), [])
+        with mock.patch("moddodo.workshop_time_updated", return_value={"731604991": 1700000000}):
+            self.assertEqual(self.dodo.outdated_mods(["731604991"]), ["731604991"])
+        self.install("731604991", "1111")
+        with mock.patch("moddodo.workshop_time_updated", side_effect=OSError("Network is unreachable")):
+            self.assertEqual(self.dodo.outdated_mods(["731604991"]), [])
+
+    def test_unreadable_manifest(self):
+        os.remove(os.path.join(self.workshop, moddodo.WORKSHOP_MANIFEST))
+        self.assertEqual(self.dodo.outdated_mods(["731604991", "555"]), ["731604991", "555"])
+
+
+if __name__ == '__main__':
+    unittest.main()
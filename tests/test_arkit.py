@@ -0,0 +1,133 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import arkit
+
+CHUNK_SIZE = 4096
+
+
+def write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+class ArchiveTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def pack(self, name, data):
+        raw = os.path.join(self.root, name)
+        write(raw, data)
+        arkit.pack(raw, raw + ".z", CHUNK_SIZE)
+        return raw + ".z"
+
+
+class UnpackResumeTest(ArchiveTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Ten full chunks and a partial one
+        self.data = os.urandom(10 * CHUNK_SIZE + 100)
+        self.src = self.pack("file", self.data)
+        self.dst = os.path.join(self.root, "out")
+
+    def unpack(self, **kwargs):
+        checkpoints = []
+        digests = []
+        stats = arkit.unpack(self.src, self.dst, checkpoint=lambda first, crcs: checkpoints.append((first, crcs)),
+                             checkpoint_bytes=3 * CHUNK_SIZE, digests=digests, **kwargs)
+        return stats, checkpoints, digests
+
+    def test_checkpoints(self):
+        stats, checkpoints, digests = self.unpack()
+        self.assertEqual(read(self.dst), self.data)
+        self.assertEqual(stats.chunks, 11)
+        self.assertEqual([first for first, crcs in checkpoints], [0, 3, 6, 9])
+        crcs = [crc for first, crcs in checkpoints for crc in crcs]
+        self.assertEqual(crcs, [zlib.crc32(self.data[i:i + CHUNK_SIZE]) for i in range(0, len(self.data), CHUNK_SIZE)])
+        self.assertEqual(arkit.unpacked_crcs(self.src, self.dst), crcs)
+        self.assertEqual(len(digests), 11)
+
+    def test_resume_after_corrupted_tail_chunk(self):
+        for workers in [1, 4]:
+            with self.subTest(workers=workers):
+                stats, checkpoints, digests = self.unpack()
+                journal = [crc for first, crcs in checkpoints[:2] for crc in crcs]
+                # Interrupted after six chunks, the last of them only partly written
+                write(self.dst, self.data[:5 * CHUNK_SIZE] + bytes(CHUNK_SIZE))
+                actual = arkit.unpacked_crcs(self.src, self.dst, len(journal))
+                self.assertEqual(actual[:5], journal[:5])
+                self.assertNotEqual(actual[5], journal[5])
+
+                stats, checkpoints, resumed_digests = self.unpack(resume=5, workers=workers, parallel_threshold=0)
+                self.assertEqual(read(self.dst), self.data)
+                self.assertEqual(stats.chunks, 6)
+                self.assertEqual(stats.bytes_written, len(self.data) - 5 * CHUNK_SIZE)
+                self.assertEqual(checkpoints[0][0], 5)
+                self.assertEqual(resumed_digests, digests)
+
+    def test_resume_out_of_range(self):
+        self.assertRaises(ValueError, arkit.unpack, self.src, self.dst, resume=12)
+
+    def test_unpacked_crcs_of_a_short_file(self):
+        write(self.dst, self.data[:2 * CHUNK_SIZE + 10])
+        self.assertEqual(len(arkit.unpacked_crcs(self.src, self.dst)), 2)
+
+
+class PatchTest(ArchiveTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.blocks = [os.urandom(CHUNK_SIZE) for i in range(8)]
+        self.base_data = b"".join(self.blocks) + b"tail"
+        self.base = os.path.join(self.root, "base")
+        self.base_chunks = []
+        arkit.unpack(self.pack("old", self.base_data), self.base, digests=self.base_chunks)
+        self.dst = os.path.join(self.root, "patched")
+
+    def test_changed_and_moved_chunks(self):
+        b = self.blocks
+        # Chunks 2 and 3 swapped, 5 changed, a chunk inserted before 6 and a new partial chunk
+        data = b[0] + b[1] + b[3] + b[2] + b[4] + os.urandom(CHUNK_SIZE) + os.urandom(CHUNK_SIZE) + b[6] + b[7] + b"new tail"
+        src = self.pack("new", data)
+        expected = []
+        arkit.unpack(src, os.path.join(self.root, "unpacked"), digests=expected)
+        for workers in [1, 4]:
+            with self.subTest(workers=workers):
+                digests = []
+                stats = arkit.patch(src, self.dst, self.base, self.base_chunks, workers=workers, digests=digests)
+                self.assertEqual(read(self.dst), data)
+                self.assertEqual(stats.chunks, 3)
+                self.assertEqual(stats.bytes_written, 2 * CHUNK_SIZE + len(b"new tail"))
+                self.assertEqual(digests, expected)
+
+    def test_unchanged(self):
+        src = self.pack("same", self.base_data)
+        stats = arkit.patch(src, self.dst, self.base, self.base_chunks)
+        self.assertEqual(read(self.dst), self.base_data)
+        self.assertEqual(stats.chunks, 0)
+
+    def test_base_does_not_match_its_chunks(self):
+        src = self.pack("new", self.base_data)
+        write(self.base, self.base_data[:-1])
+        self.assertRaises(ValueError, arkit.patch, src, self.dst, self.base, self.base_chunks)
+        self.assertFalse(os.path.exists(self.dst))
+
+
+if __name__ == '__main__':
+    unittest.main()
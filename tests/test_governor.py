@@ -0,0 +1,56 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import moddodo
+
+
+class CopyFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.src = os.path.join(self.root, "src")
+        with open(self.src, "wb") as f:
+            f.write(os.urandom(2 * moddodo.GOVERNOR_COPY_SIZE + 12345))
+        self.governor = moddodo.ResourceGovernor(sync_bytes=moddodo.GOVERNOR_COPY_SIZE)
+        throttle = mock.patch.object(self.governor, "throttle")
+        sync = mock.patch.object(self.governor, "sync")
+        self.throttle = throttle.start()
+        self.sync = sync.start()
+        self.addCleanup(throttle.stop)
+        self.addCleanup(sync.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def assertCopied(self, dst):
+        with open(self.src, "rb") as a, open(dst, "rb") as b:
+            self.assertEqual(a.read(), b.read())
+
+    def test_paced_by_the_governor(self):
+        dst = os.path.join(self.root, "dst")
+        moddodo.copy_file(self.src, dst, self.governor)
+        self.assertCopied(dst)
+        throttled = [size for (size,), kwargs in self.throttle.call_args_list]
+        self.assertEqual(sum(throttled), os.path.getsize(self.src))
+        self.assertLessEqual(max(throttled), moddodo.GOVERNOR_COPY_SIZE)
+        # Every GOVERNOR_COPY_SIZE bytes and once more at the end
+        self.assertEqual(self.sync.call_args_list, [mock.call(dst)] * 3)
+
+    def test_plain_copy_fallback(self):
+        unsupported = OSError(38, "Function not implemented")
+        with mock.patch("os.copy_file_range", side_effect=unsupported), mock.patch("os.sendfile", side_effect=unsupported):
+            moddodo.copy_file(self.src, os.path.join(self.root, "paced"), self.governor)
+            moddodo.copy_file(self.src, os.path.join(self.root, "free"))
+        self.assertCopied(os.path.join(self.root, "paced"))
+        self.assertCopied(os.path.join(self.root, "free"))
+        self.assertEqual(sum(size for (size,), kwargs in self.throttle.call_args_list), os.path.getsize(self.src))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import moddodo
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+class InstallTestCase(unittest.TestCase):
+    """
+    Installs mods downloaded by tests/fixtures/steamcmd on one server.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.content = os.path.join(self.root, "content")
+        os.makedirs(self.content)
+        self.server = os.path.join(self.root, "server")
+        os.makedirs(os.path.join(self.server, moddodo.SERVER_CHECK_PATH))
+        self.mods = os.path.join(self.server, moddodo.SERVER_MOD_DIRECTORY)
+        environ = mock.patch.dict(os.environ, {"FAKE_STEAMCMD_CONTENT": self.content})
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.dodo = moddodo.ModDodo(FIXTURES, [self.server], self.content)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+
+class UpToDateTest(InstallTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.assertTrue(self.dodo.run(["10", "20"]).success)
+
+    def test_installed_mods_are_up_to_date(self):
+        result = self.dodo.run([], mod_update=True, no_download=True)
+        self.assertEqual({modid: mod.status for modid, mod in result.mods.items()},
+                         {"10": moddodo.MOD_UP_TO_DATE, "20": moddodo.MOD_UP_TO_DATE})
+
+    def test_missing_mod_file_is_installed_again(self):
+        os.remove(os.path.join(self.mods, "10.mod"))
+        result = self.dodo.run([], mod_update=True, no_download=True)
+        self.assertEqual(result.mods["10"].status, moddodo.MOD_INSTALLED)
+        self.assertTrue(os.path.isfile(os.path.join(self.mods, "10.mod")))
+
+    def test_mod_deleted_from_the_server(self):
+        shutil.rmtree(os.path.join(self.mods, "10"))
+        os.remove(os.path.join(self.mods, "10.mod"))
+        # Forgotten by --updatemods
+        result = self.dodo.run([], mod_update=True, no_download=True)
+        self.assertEqual(list(result.mods), ["20"])
+        self.assertIsNone(moddodo.ModCatalog(self.server).get("10"))
+        # Installed again when asked for
+        result = self.dodo.run(["10"], mod_update=True, no_download=True)
+        self.assertEqual(result.mods["10"].status, moddodo.MOD_INSTALLED)
+        self.assertTrue(os.path.isdir(os.path.join(self.mods, "10")))
+
+
+class MoveFailureTest(InstallTestCase):
+
+    def test_failed_move_fails_only_that_mod(self):
+        move_mod = self.dodo.move_mod
+
+        def move(modid, *args):
+            if modid == "10":
+                raise OSError(28, "No space left on device")
+            return move_mod(modid, *args)
+        with mock.patch.object(self.dodo, "move_mod", side_effect=move):
+            result = self.dodo.run(["10", "20"])
+        self.assertFalse(result.success)
+        self.assertEqual(result.mods["10"].status, moddodo.MOD_FAILED)
+        self.assertIn("No space left on device", result.mods["10"].errors[0])
+        self.assertEqual(result.mods["20"].status, moddodo.MOD_INSTALLED)
+        self.assertTrue(os.path.isfile(os.path.join(self.mods, "20.mod")))
+
+
+class VerifyTest(InstallTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.assertTrue(self.dodo.run(["10", "20", "30"]).success)
+
+    def verify(self):
+        return self.dodo.run(["10", "20", "30"], verify=True, deep_verify=True)
+
+    def test_installed_mods(self):
+        result = self.verify()
+        self.assertTrue(result.success)
+        self.assertEqual([mod.status for mod in result.mods.values()], [moddodo.MOD_VERIFIED] * 3)
+
+    def test_unreadable_files_fail_only_their_mod(self):
+        archive = os.path.join(self.content, "10", moddodo.WINDOWS_NOEDITOR, "Content", "Fake.uasset.z")
+        os.remove(archive)
+        os.symlink(os.path.basename(archive), archive)
+        file_hash = moddodo.file_hash
+
+        def unreadable(path):
+            if os.sep + "20" + os.sep in path:
+                raise PermissionError(13, "Permission denied", path)
+            return file_hash(path)
+        with mock.patch("moddodo.file_hash", side_effect=unreadable):
+            result = self.verify()
+        self.assertEqual(result.mods["10"].status, moddodo.MOD_FAILED)
+        self.assertIn("Fake.uasset.z", result.mods["10"].errors[0])
+        self.assertEqual(result.mods["20"].status, moddodo.MOD_FAILED)
+        self.assertIn("Permission denied", result.mods["20"].errors[0])
+        self.assertEqual(result.mods["30"].status, moddodo.MOD_VERIFIED)
+
+
+class PlanTest(InstallTestCase):
+
+    def test_corrupt_chunk_is_listed_with_its_mod(self):
+        self.assertTrue(self.dodo.run(["10", "20"]).success)
+        self.dodo.full_extract = True
+        archive = os.path.join(self.content, "20", moddodo.WINDOWS_NOEDITOR, "Content", "Fake.uasset.z")
+        with open(archive, "r+b") as f:
+            f.seek(-8, os.SEEK_END)
+            f.write(b"\xff" * 8)
+        plan = self.dodo.plan(["10", "20"])
+        mods = {mod["mod"]: mod for mod in plan["mods"]}
+        self.assertEqual(mods["10"]["errors"], [])
+        self.assertEqual(len(mods["20"]["errors"]), 1)
+        self.assertIn(os.path.join("Content", "Fake.uasset.z") + ": ", mods["20"]["errors"][0])
+        self.assertIsNotNone(plan["estimated_seconds"])
+
+
+class SpaceCheckTest(InstallTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.assertTrue(self.dodo.run(["10"]).success)
+        self.dodo.plan_reserve = 1 << 60
+
+    def test_refused(self):
+        self.assertRaises(moddodo.ModDodoException, self.dodo.run, ["10"], no_download=True)
+
+    def test_kept_when_forced(self):
+        # -u -f reinstalls everything, so the biggest run keeps the check
+        self.assertRaises(moddodo.ModDodoException, self.dodo.run, ["10"], mod_update=True, no_download=True, force_update=True)
+
+    def test_skipped(self):
+        self.assertTrue(self.dodo.run(["10"], no_download=True, space_check=False).success)
+
+    def test_reserve_in_plan(self):
+        plan = self.dodo.plan(["10"])
+        self.assertEqual(plan["reserve_bytes"], 1 << 60)
+        self.assertFalse(plan["fits"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import arkit
+import moddodo
+
+
+class ExtractJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, "journal")
+        self.src = os.path.join(self.root, "a.z")
+        with open(self.src, "wb") as f:
+            f.write(b"z")
+        self.st = os.stat(self.src)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def crcs(self, relpath):
+        journal = moddodo.ExtractJournal(self.path)
+        journal.close()
+        return journal.files[relpath]["crcs"] if relpath in journal.files else []
+
+    def test_replay(self):
+        journal = moddodo.ExtractJournal(self.path)
+        journal.checkpoint("a", self.st, 0, [1, 2])
+        journal.checkpoint("a", self.st, 2, [3])
+        journal.finished("a", self.st, "hash")
+        journal.close()
+        journal = moddodo.ExtractJournal(self.path)
+        journal.close()
+        self.assertEqual(journal.files["a"], {"source": [self.st.st_size, self.st.st_mtime_ns], "crcs": [1, 2, 3], "hash": "hash"})
+
+    def test_changed_source_starts_over(self):
+        journal = moddodo.ExtractJournal(self.path)
+        journal.checkpoint("a", self.st, 0, [1, 2])
+        journal.close()
+        os.utime(self.src, ns=(self.st.st_atime_ns, self.st.st_mtime_ns + 1))
+        journal = moddodo.ExtractJournal(self.path)
+        journal.close()
+        self.assertEqual(journal.state("a", self.st.st_size, self.st.st_mtime_ns + 1)["crcs"], [])
+
+    def test_appended_after_a_torn_line(self):
+        journal = moddodo.ExtractJournal(self.path)
+        journal.checkpoint("a", self.st, 0, [1, 2])
+        journal.close()
+        # Interrupted while writing the next record
+        with open(self.path, "a") as f:
+            f.write('{"type": "chunks", "file": "a", "si')
+        self.assertEqual(self.crcs("a"), [1, 2])
+        journal = moddodo.ExtractJournal(self.path)
+        journal.checkpoint("a", self.st, 2, [3, 4])
+        journal.close()
+        self.assertEqual(self.crcs("a"), [1, 2, 3, 4])
+        # Interrupted again
+        with open(self.path, "a") as f:
+            f.write('{"type"')
+        journal = moddodo.ExtractJournal(self.path)
+        journal.checkpoint("a", self.st, 4, [5])
+        journal.close()
+        self.assertEqual(self.crcs("a"), [1, 2, 3, 4, 5])
+
+
+class JournalResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.data = os.urandom(8 * 4096 + 100)
+        raw = os.path.join(self.root, "file")
+        with open(raw, "wb") as f:
+            f.write(self.data)
+        self.src = raw + ".z"
+        arkit.pack(raw, self.src, 4096)
+        self.st = os.stat(self.src)
+        self.dst = os.path.join(self.root, "out")
+        self.path = os.path.join(self.root, "journal")
+        journal = moddodo.ExtractJournal(self.path)
+        arkit.unpack(self.src, self.dst, checkpoint=lambda first, crcs: journal.checkpoint("file.z", self.st, first, crcs),
+                     checkpoint_bytes=2 * 4096)
+        journal.finished("file.z", self.st, "hash")
+        journal.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def resume(self):
+        journal = moddodo.ExtractJournal(self.path)
+        try:
+            return journal.resume("file.z", self.src, self.st, self.dst)
+        finally:
+            journal.close()
+
+    def test_complete(self):
+        self.assertEqual(self.resume(), (9, "hash"))
+
+    def test_corrupted_tail_chunk(self):
+        with open(self.dst, "r+b") as f:
+            f.seek(5 * 4096 + 10)
+            f.write(b"\0" * 10)
+        resume, complete = self.resume()
+        self.assertEqual((resume, complete), (5, None))
+        arkit.unpack(self.src, self.dst, resume=resume)
+        with open(self.dst, "rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_linked_output_is_not_resumed(self):
+        os.link(self.dst, self.dst + ".installed")
+        self.assertEqual(self.resume(), (0, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import moddodo
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+class FakeSteamCmdTest(unittest.TestCase):
+    """
+    Runs the download driver against tests/fixtures/steamcmd, which prints SteamCMD's messages and drops small mods.
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.content = os.path.join(self.root, "content")
+        os.makedirs(self.content)
+        self.server = os.path.join(self.root, "server")
+        os.makedirs(os.path.join(self.server, moddodo.SERVER_CHECK_PATH))
+        # Restores the whole environment, including the variables set by the tests
+        environ = mock.patch.dict(os.environ, {"FAKE_STEAMCMD_CONTENT": self.content})
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.dodo = moddodo.ModDodo(FIXTURES, [self.server], self.content)
+        self.dodo.download_failures = OrderedDict()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_results_per_mod(self):
+        os.environ["FAKE_STEAMCMD_ITEMS"] = "1=success,2=failure,3=silent,4=success,5=timeout"
+        self.assertEqual(list(self.dodo.download_mods(["1", "2", "3", "4", "5"])), ["1", "4"])
+        self.assertEqual(self.dodo.download_failures, {
+            "2": "Failure",
+            "5": "Timeout",
+            "3": "SteamCMD exited with code 0 without reporting the download",
+        })
+        self.assertTrue(os.path.isdir(os.path.join(self.content, "4", moddodo.WINDOWS_NOEDITOR)))
+
+    def test_yields_while_steamcmd_runs(self):
+        gate = os.path.join(self.root, "gate")
+        os.environ["FAKE_STEAMCMD_GATE"] = gate
+        downloads = self.dodo.download_mods(["1", "2"])
+        self.assertEqual(next(downloads), "1")
+        # SteamCMD is still waiting for the gate, the first mod was handed out before it finished
+        self.assertFalse(os.path.exists(os.path.join(self.content, "2")))
+        open(gate, "w").close()
+        self.assertEqual(list(downloads), ["2"])
+        self.assertEqual(self.dodo.download_failures, {})
+
+    def test_run_installs_downloaded_and_reports_failed(self):
+        os.environ["FAKE_STEAMCMD_ITEMS"] = "10=success,20=failure,30=silent"
+        result = self.dodo.run(["10", "20", "30"], force_update=True)
+        self.assertFalse(result.success)
+        self.assertEqual(result.mods["10"].status, moddodo.MOD_INSTALLED)
+        self.assertEqual(result.mods["10"].servers, [self.server])
+        self.assertTrue(os.path.isfile(os.path.join(self.server, moddodo.SERVER_MOD_DIRECTORY, "10.mod")))
+        self.assertEqual(result.mods["20"].status, moddodo.MOD_FAILED)
+        self.assertIn("Failure", result.mods["20"].errors[0])
+        self.assertEqual(result.mods["30"].status, moddodo.MOD_FAILED)
+        self.assertIn("without reporting the download", result.mods["30"].errors[0])
+
+
+if __name__ == '__main__':
+    unittest.main()